@@ -26,41 +26,351 @@
 #
 # This program uses the Onionoo protocol - for more information go to: https://metrics.torproject.org/onionoo.html
 #
+# The status of the bridges is cached in run/bridges_check.cache. A cached status
+# younger than --max-age is used without asking Onionoo. An older one (up to
+# 24 hours) is answered immediately and revalidated in the background.
+#
+# Without access to Onionoo, the status can be taken from a snapshot: an Onionoo
+# details or summary document, which was downloaded earlier (for example with
+# https://onionoo.torproject.org/summary?type=bridge) and imported with
+# --import-snapshot. It is also used, if Onionoo can't be reached. A bridge,
+# which isn't in the snapshot, may have been set up later: its status is -1,
+# never 2, so that it isn't removed.
+#
 # SYNTAX
-# ./bridges_check.py [-i] [-n, --network=<tor|inet>] -f <fingerprint> [-s] [--info file_name] [-h, --help]
+# ./bridges_check.py [-i] [-n, --network=<tor|inet|offline>] [-m, --max-age=<seconds>] -f <fingerprint> [-s] [--info file_name] [-h, --help]
+# ./bridges_check.py [-n, --network=<tor|inet|offline>] [-m, --max-age=<seconds>] [-s] [-j, --jobs <number>] -b, --batch <file|->
+# ./bridges_check.py --import-snapshot <file>
 #
 # -h, --help: print the help screen
-# -n, --network=<tor|inet>: force check over specific network
+# -n, --network=<tor|inet|offline>: force check over specific network (offline: only use the snapshot)
 # -f <fingerprint>: search with the fingerprint
 # -f <fingerprint> -s: search with the hashed fingerprint
 # -f <fingerprint> -i: search with the fingerprint and print extended information on stdout
 # -f <fingerprint> -s -i: search with the hashed fingerprint and print extended information on stdout
 # -f <fingerprint> --info file_name: search with the fingerprint and save the extended information into file_name
 # -f <fingerprint> -s --info file_name: search with the hashed fingerprint and save the extended information into file_name
+# -b, --batch <file|->: read many fingerprints (one per line) from a file or stdin and
+#                       print one line "<fingerprint> <status>" per fingerprint
+#                       (-1 is also returned for a malformed fingerprint)
+# -j, --jobs <number>: number of parallel lookups in the batch mode (default: 4)
+# -m, --max-age <seconds>: use a cached status up to this age (default: 3600, 0: don't use the cache
+#                          and the snapshot - e.g. before a bridge is removed)
+# --import-snapshot <file>: import an Onionoo details or summary document as snapshot
 
+import os
 import sys
+import dbm
+import glob
+import time
+import fcntl
 import getopt
-import requests
 import json
+import threading
 
 from binascii import a2b_hex
 from hashlib import sha1
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'lib'))
+from torbox_network import get_network, set_network, get_proxy, get_session
+
+# Onionoo
+ONIONOO_URL = 'https://onionoo.torproject.org'
+
+# With more fingerprints than this, the batch mode downloads the status of
+# all bridges at once instead of looking up every fingerprint separately
+BULK_LOOKUP_LIMIT = 10
+
+# Default number of parallel lookups in the batch mode
+JOBS = 4
+
+# Timeouts (seconds) to connect to Onionoo and to wait for the answer - over
+# tor, a stalled circuit would otherwise hang the menu forever
+CONNECT_TIMEOUT = 30
+READ_TIMEOUT = 60
+
+# The cache of the bridge status in the TorBox run directory
+CACHE_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'run', 'bridges_check.cache')
+
+# Default for the time (seconds), a cached status is used without asking Onionoo
+CACHE_TTL = 3600
+
+# An older status is still answered, but revalidated in the background.
+# Entries older than this (seconds) are removed from the cache.
+CACHE_STALE = 24*60*60
+
+# The imported Onionoo snapshot (a dbm database: hashed fingerprint -> running)
+SNAPSHOT_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'run', 'bridges_check.snapshot')
+
+# All requests share one session, which keeps the connections to Onionoo
+# open. The first network, which worked, is used for all further requests.
+session = get_session(pool_size=JOBS)
+working_network = None
+network_lock = threading.Lock()
+
+
+# Returns the hashed fingerprint (lowercase) or False, if the fingerprint is malformed
+def hash_fingerprint(fingerprint, hashed_fingerprint=False):
+    try:
+        if hashed_fingerprint:
+            a2b_hex(fingerprint)
+            return fingerprint.lower()
+        return sha1(a2b_hex(fingerprint)).hexdigest()
+    except:
+        return False
+
+
+# Gets an Onionoo document or returns False on a connection error. With the
+# Last-Modified of an earlier answer, Onionoo answers 304, if nothing changed.
+# Any other answer than 200 or 304 (e.g. 503) is handled like a connection error.
+def onionoo_get(url, network, modified=None):
+    global working_network
+
+    if network in ('tor', 'inet'):
+        networks = [get_proxy(network)]
+    elif working_network is not None:
+        networks = [working_network]
+    elif get_network() == 'tor':
+        # Tor is up, but may not have a circuit yet - then try over clearnet
+        networks = [get_proxy('tor'), get_proxy('inet')]
+    else:
+        networks = [get_proxy('inet')]
+
+    for proxies in networks:
+        try:
+            headers = {'If-Modified-Since': modified} if modified else {}
+            r = session.get(url, headers=headers, proxies=proxies, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        except:
+            continue
+        if r.status_code not in (200, 304):
+            continue
+        with network_lock:
+            working_network = proxies
+        # Tor accepted the connection, but couldn't reach Onionoo - the other tools shouldn't try it again
+        if proxies != networks[0]:
+            set_network('inet')
+        return r
+    return False
+
+
+# 0: bridge exists and is offline / 1: bridge exists and is online
+def bridge_status(b):
+    # Running
+    if b['running']:
+        return 1 # ONLINE
+    # Not running
+    return 0 # OFFLINE
+
+
+# Asks Onionoo for the status of the hashed fingerprints. Returns a dict with
+# the status and the Last-Modified of the answer. Bridges not in the returned
+# dict couldn't be checked because of a connection error. Only the fields we
+# need are requested and cached bridges are only transferred, if their
+# status could have changed since.
+def fetch_statuses(hashes, network, jobs=JOBS, cache={}):
+    statuses = {}
+    if len(hashes) > BULK_LOOKUP_LIMIT:
+        # One request for the status of all bridges
+        modified = None
+        if all(cache.get(h, {}).get('modified') for h in hashes):
+            modified = min((cache[h]['modified'] for h in hashes), key=parsedate_to_datetime)
+        r = onionoo_get(f"{ONIONOO_URL}/details?type=bridge&fields=hashed_fingerprint,running", network, modified)
+        if r and r.status_code == 304:
+            for h in hashes:
+                statuses[h] = (cache[h]['status'], cache[h]['modified'])
+        elif r:
+            modified = r.headers.get('Last-Modified')
+            # An answer without the bridges is handled like a connection error
+            try:
+                bridges = {b['hashed_fingerprint'].lower(): b for b in r.json()['bridges']}
+                statuses = {h: (bridge_status(bridges[h]) if h in bridges else 2, modified) for h in hashes}
+            except (ValueError, KeyError, TypeError, AttributeError):
+                pass
+    elif hashes:
+        def lookup(h):
+            modified = cache.get(h, {}).get('modified')
+            r = onionoo_get(f"{ONIONOO_URL}/details?lookup={h}&fields=hashed_fingerprint,running", network, modified)
+            if r and r.status_code == 304:
+                statuses[h] = (cache[h]['status'], modified)
+            elif r:
+                try:
+                    bridges = r.json()['bridges']
+                    statuses[h] = (bridge_status(bridges[0]) if len(bridges) else 2, r.headers.get('Last-Modified'))
+                except (ValueError, KeyError, TypeError, IndexError):
+                    pass
+
+        # The first lookup finds the working network, the others run in parallel
+        hashes = sorted(hashes)
+        lookup(hashes[0])
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            list(executor.map(lookup, hashes[1:]))
+    return statuses
+
+
+def load_cache():
+    try:
+        with open(CACHE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+# Merges the checked bridges into the cache (other processes may write at the same time)
+def save_cache(statuses):
+    if not statuses:
+        return
+    now = time.time()
+    try:
+        with open(CACHE_FILE + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            cache = load_cache()
+            for h, (status, modified) in statuses.items():
+                cache[h] = {"status": status, "checked": now, "modified": modified}
+            cache = {h: entry for h, entry in cache.items() if now - entry['checked'] < CACHE_STALE}
+            with open(CACHE_FILE + '.tmp', 'w') as f:
+                json.dump(cache, f)
+            os.replace(CACHE_FILE + '.tmp', CACHE_FILE)
+    except OSError:
+        pass
+
+
+# Indexes an Onionoo details or summary document by the hashed fingerprint.
+# Returns the number of bridges and the time the document was published.
+def import_snapshot(snapshot_file):
+    with open(snapshot_file) as f:
+        data = json.load(f)
+    published = data.get('bridges_published', '')
+
+    # The new database replaces the old one only when it is complete
+    new_file = SNAPSHOT_FILE + '.new'
+    count = 0
+    with dbm.open(new_file, 'n') as db:
+        for b in data.get('bridges', []):
+            # Details documents use long field names, summary documents short ones
+            h = b.get('hashed_fingerprint', b.get('h'))
+            if not h:
+                continue
+            db[h.lower()] = '1' if b.get('running', b.get('r')) else '0'
+            count += 1
+        db['published'] = published
+    for f in glob.glob(new_file + '*'):
+        os.replace(f, SNAPSHOT_FILE + f[len(new_file):])
+    return count, published
+
+
+# Returns the status of the hashed fingerprints from the snapshot (-1 for a
+# bridge not in the snapshot) and reports its age on stderr
+def snapshot_statuses(hashes):
+    try:
+        db = dbm.open(SNAPSHOT_FILE, 'r')
+    except dbm.error:
+        return {}
+    with db:
+        published = db.get('published', b'').decode()
+        statuses = {h: int(db.get(h, b'-1')) for h in hashes}
+    try:
+        age = datetime.now(timezone.utc) - datetime.strptime(published, '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+        print(f"[!] Status from the Onionoo snapshot of {published} UTC ({int(age.total_seconds() // 3600)} hours old)", file=sys.stderr)
+    except ValueError:
+        print("[!] Status from an Onionoo snapshot of unknown age", file=sys.stderr)
+    return statuses
+
+
+# Returns the status of the hashed fingerprints (from the cache, if possible)
+# and the fingerprints, which were answered from an outdated cache entry
+def get_statuses(hashes, network, jobs=JOBS, max_age=CACHE_TTL):
+    if network == 'offline':
+        return snapshot_statuses(hashes), []
+
+    statuses = {}
+    stale = []
+    cache = {}
+    if max_age > 0:
+        now = time.time()
+        cache = load_cache()
+        for h in hashes:
+            if h not in cache:
+                continue
+            age = now - cache[h]['checked']
+            if age <= CACHE_STALE:
+                statuses[h] = cache[h]['status']
+                if age > max_age:
+                    stale.append(h)
+
+    fetched = fetch_statuses([h for h in hashes if h not in statuses], network, jobs, cache)
+    save_cache(fetched)
+    for h, (status, modified) in fetched.items():
+        statuses[h] = status
+
+    # Onionoo couldn't be reached - without max_age, only a current status is wanted
+    missing = [h for h in hashes if h not in statuses]
+    if missing and max_age > 0:
+        statuses.update(snapshot_statuses(missing))
+    return statuses, stale
+
+
+# The outdated answers are already printed - the caller doesn't have to wait
+# until they are revalidated, therefore we continue in a detached child process
+def revalidate(stale, network, jobs=JOBS):
+    if not stale:
+        return
+    sys.stdout.flush()
+    try:
+        pid = os.fork()
+    except OSError:
+        return
+    if pid:
+        return
+    try:
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        # Don't share the connections of the parent process
+        session.close()
+        save_cache(fetch_statuses(stale, network, jobs, load_cache()))
+    finally:
+        os._exit(0)
+
+
+# Checks many bridges with one process. The result is printed in the order of the input.
+def check_batch(batch_file, network, hashed_fingerprint, jobs=JOBS, max_age=CACHE_TTL):
+    if batch_file == '-':
+        lines = sys.stdin.read().split()
+    else:
+        with open(batch_file) as f:
+            lines = f.read().split()
+    fingerprints = [(fp, hash_fingerprint(fp, hashed_fingerprint)) for fp in lines if not fp.startswith('#')]
+    hashes = sorted({h for fp, h in fingerprints if h})
+
+    statuses, stale = get_statuses(hashes, network, jobs, max_age)
+    for fp, h in fingerprints:
+        print(f"{fp} {statuses.get(h, -1)}")
+    revalidate(stale, network, jobs)
 
-# Tor socks
-SOCKS_HOST = '127.0.0.1'
-SOCKS_PORT = 9050
 
 # get the options from cmd line
 options, remainder = getopt.getopt(sys.argv[1:],
-                                   'n:f:ish',
+                                   'n:f:b:j:m:ish',
                                    ['network=',
                                     'fingerprint=',
+                                    'batch=',
+                                    'jobs=',
+                                    'max-age=',
+                                    'import-snapshot=',
                                     'info=',
                                     'help',
                                     'hashed-fingerprint'])
 
 network = False
 fingerprint = False
+batch_file = False
+jobs = JOBS
+max_age = CACHE_TTL
+snapshot_file = False
 hashed_fingerprint = False
 get_info_file = False
 show_info = False
@@ -70,6 +380,22 @@ for opt, arg in options:
         network = arg
     if opt in ('-f', '--fingerprint'):
         fingerprint = arg
+    elif opt in ('-b', '--batch'):
+        batch_file = arg
+    elif opt in ('-j', '--jobs'):
+        try:
+            jobs = int(arg)
+        except ValueError:
+            print("[X] Invalid number of jobs")
+            quit()
+    elif opt in ('-m', '--max-age'):
+        try:
+            max_age = int(arg)
+        except ValueError:
+            print("[X] Invalid maximum age")
+            quit()
+    elif opt == '--import-snapshot':
+        snapshot_file = arg
     elif opt in ('-i', '--info'):
         if arg == '':
             show_info = True
@@ -77,62 +403,65 @@ for opt, arg in options:
     elif opt in ('-s', '--hashed-fingerprint'):
         hashed_fingerprint = True
     elif opt in ('-h', '--help'):
-        print(f"Usage:\n {sys.argv[0]} [-i] -f <fingerprint>\n\n"\
+        print(f"Usage:\n {sys.argv[0]} [-i] -f <fingerprint>\n {sys.argv[0]} -b <file|->\n {sys.argv[0]} --import-snapshot=<file>\n\n"\
                 "Options:\n"\
-                " -n, --network=<tor|inet>\t\tForce check over specific network\n"\
+                " -n, --network=<tor|inet|offline>\tForce check over specific network (offline: only use the snapshot)\n"\
                 " -f, --fingerprint=<fingerprint>\tGet status of a tor bridge (0: offline, 1: online, 2: not exists) [REQUIRED PARAM]\n"\
                         "\t\t\t\t\tFingerprint must not be hashed\n"\
                 " -s, --hashed-fingerprint\t\tSearch for hashed fingerprint\n"\
+                " -b, --batch=<file|->\t\t\tGet status of many bridges (one fingerprint per line, - for stdin)\n"\
+                "\t\t\t\t\tPrints one line \"<fingerprint> <status>\" per fingerprint\n"\
+                " -j, --jobs=<number>\t\t\tNumber of parallel lookups in the batch mode (default: 4)\n"\
+                " -m, --max-age=<seconds>\t\tUse a cached status up to this age (default: 3600, 0: neither the cache nor the snapshot)\n"\
+                " --import-snapshot=<file>\t\tImport an Onionoo details or summary document as snapshot\n"\
                 " -i, --info <file_name>\t\t\tSave the info from bridge and save to file in JSON format (-i prints to stdout)\n"\
                 " -h, --help\t\t\t\tshow this help\n")
         quit()
 
+if snapshot_file:
+    try:
+        count, published = import_snapshot(snapshot_file)
+        print(f"[+] Imported {count} bridges from the Onionoo snapshot of {published or 'unknown date'}")
+    except (OSError, ValueError, AttributeError, *dbm.error):
+        print("[X] Snapshot can't be imported")
+    quit()
+
+if batch_file:
+    try:
+        check_batch(batch_file, network, hashed_fingerprint, jobs, max_age)
+    except OSError:
+        print("[X] Batch file can't be read")
+    quit()
+
 # if fingerprint not passed, we show how to use it. fingerprint is required
 if not fingerprint:
     print("Usage: %s -f <fingerprint>\nCheck '%s --help' for more info" % (sys.argv[0], sys.argv[0]) )
     quit()
 
 # if fingerprint is not hashed, we hash it before search
-if not hashed_fingerprint:
-    try:
-        fingerprint = sha1(a2b_hex(fingerprint)).hexdigest()
-    except:
-        print("[X] Fingerprint format error")
-        quit()
-
-# search for the fingerprint in the torproject
-url = 'https://onionoo.torproject.org/details?lookup=%s' % fingerprint
-# Tor proxy
-proxy = {'https': f"socks5h://{SOCKS_HOST}:{SOCKS_PORT}"}
+fingerprint = hash_fingerprint(fingerprint, hashed_fingerprint)
+if not fingerprint:
+    print("[X] Fingerprint format error")
+    quit()
 
-if network == 'inet':
-    try:
-        r = requests.get(url)
-    except:
-        # Error
-        print(-1)
-        quit()
-elif network == 'tor':
-    try:
-        r = requests.get(url, proxies=proxy)
-    except:
-        print(-1)
-        quit()
-else:
-    # Always go over tor first
-    try:
-        r = requests.get(url, proxies=proxy)
-    except:
-        # Tor not running, try over clearnet
-        try:
-            r = requests.get(url)
-        except:
-            # Error
-            print(-1)
-            quit()
+# Without extended information, the status may come from the cache or the snapshot
+if network == 'offline' or (not show_info and not get_info_file):
+    statuses, stale = get_statuses([fingerprint], network, max_age=max_age)
+    print(statuses.get(fingerprint, -1))
+    revalidate(stale, network)
+    quit()
 
-# load json data
-data = json.loads(r.text)
+# search for the fingerprint in the torproject (with all details)
+r = onionoo_get(f"{ONIONOO_URL}/details?lookup={fingerprint}", network)
+try:
+    data = r.json() if r else False
+    data['bridges']
+except (ValueError, KeyError, TypeError):
+    data = False
+if not data:
+    # Error
+    print(-1)
+    quit()
 
 # if we get bridges, then it exist
 if len(data['bridges']):
@@ -144,12 +473,8 @@ if len(data['bridges']):
         f.write("{}".format(b))
         f.close()
 
-    # Running
-    if b['running']:
-        res = 1 # ONLINE
-    # Not running
-    else:
-        res = 0 # OFFLINE
+    res = bridge_status(b)
+    save_cache({fingerprint: (res, r.headers.get('Last-Modified'))})
 
     if show_info:
         print("%s:{}".format(b) % (res))
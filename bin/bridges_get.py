@@ -26,6 +26,22 @@
 # The bridge database delivers only 1-3 bridges approximately every 24 hours,
 # of which we pick one. With the bridges already delivered this should be sufficient.
 #
+# Solving the captcha is a pipeline: up to --parallel captchas are on the way
+# to or from moat at the same time and the next captcha is fetched while the
+# current one is read. After --attempts captchas or --deadline seconds we give up.
+#
+# The captchas are read by one Tesseract instance, which loads its language
+# data only once: with the Python module tesserocr, if it is installed, or
+# else directly with libtesseract (it comes with the package tesseract-ocr).
+# Only if neither is available, pytesseract starts a new tesseract process
+# for every read - then fewer variants are read (see below).
+#
+# Every captcha is read in several variants (different thresholds and noise
+# filters). The text with the best score is submitted: the confidence of
+# Tesseract, with a penalty for the wrong length and a bonus for texts read
+# in more than one variant. With pytesseract, only the first PROCESS_VARIANTS
+# variants are read and we stop, as soon as two of them agree.
+#
 # SYNTAX
 # Usage: bridges_get.py [OPTIONS]
 #
@@ -34,45 +50,92 @@
 #   -c, --country TEXT  Circumvention country setting - <TEXT> has to be in lowercase
 #   --snowflake         Get snowflake bridges instead of obfs4 (circumvention
 #                       country need to be set)
+#   --attempts INTEGER  Maximum number of captchas to solve (default: 10)
+#   --deadline INTEGER  Maximum time in seconds to solve a captcha (default: 300)
+#   --parallel INTEGER  Number of captchas in flight (default: 2)
+#   --stats             Print the attempts, the success rate and the time per
+#                       stage on stderr
+#   --ocr-benchmark INTEGER
+#                       Read INTEGER generated captchas with every available
+#                       OCR engine and print the time per captcha
+#   --captcha-benchmark DIRECTORY
+#                       Read the captchas in DIRECTORY (named <text>.jpg) and
+#                       print the accuracy, the time per stage and the
+#                       throughput (no network needed)
+#   --save-captchas DIRECTORY
+#                       Save the captchas from moat in DIRECTORY (solved ones
+#                       as <text>.jpg, the others in DIRECTORY/unsolved)
 #   --help              Show this message and exit.
 #
 # ERROR CODES:
-# -1: Network error
+# -1: Network error (or no captcha solved within the attempts or the deadline)
 # -2: Bridges not found
 
 
 import click
+import os
 import sys
+import time
 import base64
+import ctypes
+import ctypes.util
+import random
 import requests
 import numpy as np
 import cv2 as cv
-from pytesseract import image_to_string
+from pytesseract import image_to_data, Output
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'lib'))
+from torbox_network import get_session
 
-def get_proxy(network=''):
-    # Tor Socks Proxy
-    proxy = {
-        "http": "socks5h://127.0.0.1:9050",
-        "https": "socks5h://127.0.0.1:9050",
-    }
+# tesserocr is optional (it has to be compiled against libtesseract)
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
 
-    if not network:
-        # Check if Tor proxy is up, otherwise set inet network
-        try:
-            r = requests.get("https://torproject.org", proxies=proxy, timeout=5)
-        except:  # noqa
-            network = 'inet'
+# The names under which libtesseract may be installed
+LIBTESSERACT = (ctypes.util.find_library('tesseract'), 'libtesseract.so.5', 'libtesseract.so.4')
+
+# Defaults for solving the captcha
+ATTEMPTS = 10
+DEADLINE = 300
+PARALLEL = 2
+
+# Timeouts (seconds) for the connection to moat
+CONNECT_TIMEOUT = 30
+READ_TIMEOUT = 60
+
+# The characters used in the captchas
+CAPTCHA_CHARS = '0123456789' \
+                'ABCDEFGHIJKMNLOPKRSTUVWXYZ' \
+                'abcdefghijklmnopqrstuvwxyz'
+
+# The usual number of characters in a captcha
+CAPTCHA_LENGTH = 7
 
-    if network == "inet":
-        proxy = {
-            "http": "",
-            "https": "",
-        }
-    return proxy
+# The variants of the captcha, which are read: the thresholds of the grayscale
+# image (the most successful first) and the sizes of the filter against the noise
+THRESHOLDS = (100, 127, 80, 160)
+KERNEL_SIZES = (3, 5)
 
+# With pytesseract, every read starts a tesseract process: only the color
+# image and the 3x3 filtered images with the first two thresholds are read
+PROCESS_VARIANTS = 3
 
-def get_challenge(proxy):
+# Scoring of the read texts: the confidence (0-100) of Tesseract minus a
+# penalty for every missing or additional character plus a bonus for every
+# other variant with the same text
+LENGTH_PENALTY = 15
+AGREEMENT_BONUS = 10
+
+# Texts read with this confidence are submitted without reading other variants
+CONFIDENT = 95
+
+
+# Returns the captcha image, the challenge and the transport or False on a network error
+def get_challenge(session, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)):
     moat_fetch = "https://bridges.torproject.org/moat/fetch"
     headers = {"Content-type": "application/vnd.api+json"}
     data = {
@@ -84,13 +147,12 @@ def get_challenge(proxy):
     }
 
     try:
-        r = requests.post(moat_fetch, json=data, proxies=proxy, headers=headers)
+        r = session.post(moat_fetch, json=data, headers=headers, timeout=timeout)
         r = r.json()
         r = r["data"][0]
+        return r["image"], r["challenge"], r["transport"]
     except:
-        print(-1)
-        quit()
-    return r["image"], r["challenge"], r["transport"]
+        return False
 
 
 def readb64(encoded_data):
@@ -99,24 +161,273 @@ def readb64(encoded_data):
    return img
 
 
-def beat_captcha(image):
-    img = readb64(image)
-    ret, img = cv.threshold(img, 100, 255, cv.THRESH_BINARY)
+# Returns libtesseract with the functions of its C-API, which we use, or
+# None, if it isn't installed
+def load_libtesseract():
+    for name in LIBTESSERACT:
+        if not name:
+            continue
+        try:
+            lib = ctypes.CDLL(name)
+        except OSError:
+            continue
+        handle = ctypes.c_void_p
+        lib.TessBaseAPICreate.restype = handle
+        lib.TessBaseAPICreate.argtypes = []
+        lib.TessBaseAPIInit3.restype = ctypes.c_int
+        lib.TessBaseAPIInit3.argtypes = [handle, ctypes.c_char_p, ctypes.c_char_p]
+        lib.TessBaseAPISetVariable.restype = ctypes.c_int
+        lib.TessBaseAPISetVariable.argtypes = [handle, ctypes.c_char_p, ctypes.c_char_p]
+        lib.TessBaseAPISetImage.restype = None
+        lib.TessBaseAPISetImage.argtypes = [handle, ctypes.c_char_p, ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_int]
+        # The text has to be freed with TessDeleteText - therefore not c_char_p
+        lib.TessBaseAPIGetUTF8Text.restype = ctypes.c_void_p
+        lib.TessBaseAPIGetUTF8Text.argtypes = [handle]
+        lib.TessDeleteText.restype = None
+        lib.TessDeleteText.argtypes = [ctypes.c_void_p]
+        lib.TessBaseAPIMeanTextConf.restype = ctypes.c_int
+        lib.TessBaseAPIMeanTextConf.argtypes = [handle]
+        lib.TessBaseAPIEnd.restype = None
+        lib.TessBaseAPIEnd.argtypes = [handle]
+        lib.TessBaseAPIDelete.restype = None
+        lib.TessBaseAPIDelete.argtypes = [handle]
+        return lib
+    return None
+
+
+# The part of tesserocr's PyTessBaseAPI, which we use, on top of libtesseract
+class TessBaseAPI:
+    def __init__(self, lib, lang='eng'):
+        self.lib = lib
+        self.handle = lib.TessBaseAPICreate()
+        # Without a path, the language data is searched in TESSDATA_PREFIX or Tesseract's default
+        if lib.TessBaseAPIInit3(self.handle, None, lang.encode()) != 0:
+            lib.TessBaseAPIDelete(self.handle)
+            raise RuntimeError("Failed to init API, possibly an invalid tessdata path")
+
+    def SetVariable(self, name, value):
+        return bool(self.lib.TessBaseAPISetVariable(self.handle, name.encode(), value.encode()))
+
+    # Tesseract copies the image - the bytes don't have to outlive the call
+    def SetImageBytes(self, imagedata, width, height, bytes_per_pixel, bytes_per_line):
+        self.lib.TessBaseAPISetImage(self.handle, imagedata, width, height, bytes_per_pixel, bytes_per_line)
+
+    def GetUTF8Text(self):
+        text = self.lib.TessBaseAPIGetUTF8Text(self.handle)
+        if not text:
+            return ''
+        try:
+            return ctypes.string_at(text).decode('utf-8', 'replace')
+        finally:
+            self.lib.TessDeleteText(text)
+
+    def MeanTextConf(self):
+        return self.lib.TessBaseAPIMeanTextConf(self.handle)
+
+    def End(self):
+        self.lib.TessBaseAPIEnd(self.handle)
+        self.lib.TessBaseAPIDelete(self.handle)
+
+
+# Reads the text of the captchas. With tesserocr or libtesseract, the language
+# data is loaded once and every captcha only pays for the recognition. The
+# worker isn't thread-safe; the captchas are read one after another.
+class OcrWorker:
+    def __init__(self, engine=None):
+        self.api = None
+        self.engine = 'pytesseract'
+        if tesserocr and engine in (None, 'tesserocr'):
+            try:
+                self.api = tesserocr.PyTessBaseAPI()
+                self.engine = 'tesserocr'
+            except RuntimeError:
+                # Tesseract's language data not found
+                self.api = None
+        if self.api is None and engine in (None, 'libtesseract'):
+            lib = load_libtesseract()
+            try:
+                if lib:
+                    self.api = TessBaseAPI(lib)
+                    self.engine = 'libtesseract'
+            except RuntimeError:
+                self.api = None
+        if self.api is not None:
+            self.api.SetVariable('tessedit_char_whitelist', CAPTCHA_CHARS)
+
+    # Returns the text (without whitespace) and its mean confidence (0-100)
+    def read(self, img):
+        if self.api is None:
+            data = image_to_data(img, config='-c tessedit_char_whitelist=' + CAPTCHA_CHARS, output_type=Output.DICT)
+            words = [(word, float(conf)) for word, conf in zip(data['text'], data['conf']) if word.strip()]
+            if not words:
+                return '', 0
+            return "".join("".join(word.split()) for word, conf in words), sum(conf for word, conf in words) / len(words)
+        if img.ndim == 2:
+            height, width = img.shape
+            depth = 1
+        else:
+            img = cv.cvtColor(img, cv.COLOR_BGR2RGB)
+            height, width, depth = img.shape
+        self.api.SetImageBytes(img.tobytes(), width, height, depth, width * depth)
+        return "".join(self.api.GetUTF8Text().split()), self.api.MeanTextConf()
+
+    def close(self):
+        if self.api is not None:
+            self.api.End()
+            self.api = None
+
+
+# Returns the binary images: the color image with the threshold 100 and the
+# grayscale image with all THRESHOLDS at once (one channel per threshold)
+def threshold(img):
+    ret, original = cv.threshold(img, 100, 255, cv.THRESH_BINARY)
+    gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
+    binary = np.where(gray[:, :, np.newaxis] > np.array(THRESHOLDS, np.uint8), 255, 0).astype(np.uint8)
+    return original, binary
+
+
+# Returns the variants of the captcha, which are read. The first one is the
+# color image with the 5x5 filter.
+def denoise(original, binary):
+    variants = [cv.morphologyEx(original, cv.MORPH_OPEN, np.ones((5, 5), np.uint8))]
+    for size in KERNEL_SIZES:
+        opened = cv.morphologyEx(binary, cv.MORPH_OPEN, np.ones((size, size), np.uint8))
+        variants.extend(np.ascontiguousarray(opened[:, :, i]) for i in range(len(THRESHOLDS)))
+    return variants
+
 
-    kernel = np.ones((5, 5), np.uint8)
-    img = cv.morphologyEx(img, cv.MORPH_OPEN, kernel)
+def score(text, confidence, agreement):
+    return confidence - LENGTH_PENALTY * abs(len(text) - CAPTCHA_LENGTH) + AGREEMENT_BONUS * (agreement - 1)
 
-    # Read chars from img
-    captcha_text = image_to_string(img,
-                                   config='-c tessedit_char_whitelist=' \
-                                          '0123456789' \
-                                          'ABCDEFGHIJKMNLOPKRSTUVWXYZ' \
-                                          'abcdefghijklmnopqrstuvwxyz')
-    captcha_text = captcha_text.strip()
-    return captcha_text
 
+# Reads chars from every variant and returns the text with the best score
+def read_variants(variants, ocr):
+    candidates = {}
+    process = ocr.engine == 'pytesseract'
+    for variant in variants[:PROCESS_VARIANTS] if process else variants:
+        text, confidence = ocr.read(variant)
+        if not text:
+            continue
+        if confidence >= CONFIDENT and len(text) == CAPTCHA_LENGTH:
+            return text
+        candidates.setdefault(text, []).append(confidence)
+        # Every further read would cost a tesseract process
+        if process and len(candidates[text]) > 1:
+            return text
+    if not candidates:
+        return ''
+    return max(candidates, key=lambda text: score(text, max(candidates[text]), len(candidates[text])))
 
-def solve_challenge(captcha_text, challenge, transport, proxy):
+
+# The time of every stage is added to times (a dict), if it is given
+def beat_captcha(image, ocr=None, times=None):
+    if ocr is None:
+        ocr = OcrWorker()
+
+    def timed(stage, func, *args):
+        start = time.monotonic()
+        result = func(*args)
+        if times is not None:
+            times[stage] = times.get(stage, 0) + time.monotonic() - start
+        return result
+
+    img = timed('decode', readb64, image)
+    original, binary = timed('threshold', threshold, img)
+    variants = timed('morphology', denoise, original, binary)
+    return timed('ocr', read_variants, variants, ocr)
+
+
+# Saves a captcha from moat in the corpus for --captcha-benchmark. Solved
+# captchas are named by their text, the others are saved in unsolved/ with
+# the text we have read.
+def save_captcha(directory, image, text, solved):
+    data = base64.b64decode(image)
+    extension = '.png' if data.startswith(b'\x89PNG') else '.jpg'
+    if not solved:
+        directory = os.path.join(directory, 'unsolved')
+    try:
+        os.makedirs(directory, exist_ok=True)
+        name = os.path.join(directory, text or 'empty')
+        path, i = name + extension, 1
+        while os.path.exists(path):
+            i += 1
+            path = f"{name}_{i}{extension}"
+        with open(path, 'wb') as f:
+            f.write(data)
+    except OSError:
+        pass
+
+
+# Reads the captchas of a corpus (files named <text>.jpg, <text>_2.png, ...)
+# and prints the accuracy, the time per stage and the throughput
+def benchmark_captchas(directory):
+    corpus = []
+    for name in sorted(os.listdir(directory)):
+        stem, extension = os.path.splitext(name)
+        if extension.lower() in ('.jpg', '.jpeg', '.png'):
+            with open(os.path.join(directory, name), 'rb') as f:
+                corpus.append((base64.b64encode(f.read()), stem.split('_')[0]))
+    if not corpus:
+        print("[X] No captchas found")
+        return
+
+    ocr = OcrWorker()
+    times = {}
+    correct = 0
+    start = time.monotonic()
+    for image, text in corpus:
+        correct += beat_captcha(image, ocr, times) == text
+    elapsed = time.monotonic() - start
+    ocr.close()
+
+    count = len(corpus)
+    print(f"[i] {correct}/{count} captchas read correctly ({100 * correct / count:.1f}%) with {ocr.engine}")
+    print("[i] Average time per stage - " + ", ".join(f"{stage}: {1000 * t / count:.1f} ms" for stage, t in times.items()))
+    print(f"[i] {count / elapsed:.1f} captchas per second")
+
+
+# Returns a captcha like the ones of moat (base64 encoded) and its text
+def sample_captcha():
+    text = "".join(random.choice(CAPTCHA_CHARS) for i in range(CAPTCHA_LENGTH))
+    img = np.full((125, 400, 3), random.randint(150, 255), np.uint8)
+    for i in range(8):
+        # Noise like the lines and dots in moat's captchas
+        points = [(random.randrange(400), random.randrange(125)) for j in range(2)]
+        cv.line(img, points[0], points[1], [random.randrange(256)] * 3, random.randint(1, 3))
+    cv.putText(img, text, (15, 85), cv.FONT_HERSHEY_SIMPLEX, 2, (0, 0, 0), 4)
+    img = cv.GaussianBlur(img, (3, 3), 0)
+    return base64.b64encode(cv.imencode('.png', img)[1].tobytes()), text
+
+
+# Compares the time per captcha of the available OCR engines
+def benchmark_ocr(count):
+    samples = [sample_captcha() for i in range(count)]
+    engines = ['pytesseract'] + (['tesserocr'] if tesserocr else []) + (['libtesseract'] if load_libtesseract() else [])
+    for engine in engines:
+        start = time.monotonic()
+        ocr = OcrWorker(engine)
+        startup = time.monotonic() - start
+        if ocr.engine != engine:
+            print(f"[!] {engine} isn't usable")
+            continue
+        correct = 0
+        start = time.monotonic()
+        try:
+            for image, text in samples:
+                correct += beat_captcha(image, ocr) == text
+        except (OSError, RuntimeError):
+            # The tesseract program isn't installed
+            print(f"[!] {engine} isn't usable")
+            continue
+        finally:
+            ocr.close()
+        elapsed = time.monotonic() - start
+        print(f"[i] {engine}: {1000 * elapsed / count:.1f} ms per captcha "
+              f"(startup {1000 * startup:.1f} ms), {correct}/{count} read correctly")
+
+
+# Returns the bridges, False for a wrong solution or None on a network error
+def solve_challenge(captcha_text, challenge, transport, session, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)):
     moat_check = "https://bridges.torproject.org/moat/check"
     headers = {"Content-type": "application/vnd.api+json"}
     data = {
@@ -130,32 +441,111 @@ def solve_challenge(captcha_text, challenge, transport, proxy):
             "qrcode": "false",
         }]
     }
-    r = requests.post(moat_check, json=data, proxies=proxy, headers=headers)
-    r = r.json()
+    try:
+        r = session.post(moat_check, json=data, headers=headers, timeout=timeout)
+        r = r.json()
+    except:
+        return None
     if r.get('errors'):
         return False
     return r["data"][0]["bridges"]
 
 
-def get_bridges(network):
-    proxy = get_proxy(network)
-    bridges = False
-    while not bridges:
-        captcha_img, challenge, transport = get_challenge(proxy)
-        captcha_text = beat_captcha(captcha_img)
-        bridges = solve_challenge(captcha_text, challenge, transport, proxy)
+# Counts the attempts and measures the time of every stage
+class SolveStats:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.attempts = 0
+        self.solved = 0
+        self.errors = 0
+        self.times = {'fetch': [], 'ocr': [], 'check': []}
+
+    def timed(self, stage, func, *args):
+        start = time.monotonic()
+        try:
+            return func(*args)
+        finally:
+            self.times[stage].append(time.monotonic() - start)
+
+    def report(self):
+        checked = len(self.times['check'])
+        rate = 100 * self.solved / checked if checked else 0
+        stages = ", ".join(f"{stage}: {sum(t) / len(t):.2f}s" for stage, t in self.times.items() if t)
+        print(f"[i] {self.attempts} attempts, {self.solved} solved ({rate:.0f}%), {self.errors} network errors, "
+              f"{time.monotonic() - self.start:.1f}s total", file=sys.stderr)
+        if stages:
+            print(f"[i] Average time per stage - {stages}", file=sys.stderr)
+
 
-    return bridges
+def get_bridges(network, attempts=ATTEMPTS, deadline=DEADLINE, parallel=PARALLEL, stats=None, save_dir=None):
+    session = get_session(network, pool_size=parallel + 1)
+    stats = stats or SolveStats()
+    end = time.monotonic() + deadline
+    ocr = OcrWorker()
+
+    # No request may last longer than the deadline
+    def timeout():
+        left = max(1, end - time.monotonic())
+        return min(CONNECT_TIMEOUT, left), min(READ_TIMEOUT, left)
+
+    executor = ThreadPoolExecutor(max_workers=parallel + 1)
+    challenges = []
+    checks = {}
+    requested = 0
+
+    # Keeps parallel captchas on the network. It is also called before a
+    # captcha is read, so that the next one is already on the way.
+    def fill():
+        nonlocal requested
+        while requested < attempts and len(challenges) + len(checks) < parallel:
+            challenges.append(executor.submit(stats.timed, 'fetch', get_challenge, session, timeout()))
+            requested += 1
+
+    try:
+        fill()
+        while challenges or checks:
+            left = end - time.monotonic()
+            if left <= 0:
+                break
+            done, _ = wait(challenges + list(checks), timeout=left, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in checks:
+                    captcha_img, captcha_text = checks.pop(future)
+                    bridges = future.result()
+                    if save_dir and bridges is not None:
+                        save_captcha(save_dir, captcha_img, captcha_text, bool(bridges))
+                    if bridges:
+                        stats.solved += 1
+                        return bridges
+                    if bridges is None:
+                        stats.errors += 1
+                else:
+                    challenges.remove(future)
+                    fill()
+                    challenge = future.result()
+                    if not challenge:
+                        stats.errors += 1
+                        continue
+                    stats.attempts += 1
+                    captcha_img, challenge, transport = challenge
+                    captcha_text = stats.timed('ocr', beat_captcha, captcha_img, ocr)
+                    future = executor.submit(stats.timed, 'check', solve_challenge, captcha_text, challenge, transport, session, timeout())
+                    checks[future] = (captcha_img, captcha_text)
+            fill()
+        return False
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        ocr.close()
 
 
 def get_circumvention_bridges(country, network, snowflake):
-    proxy = get_proxy(network)
+    session = get_session(network)
     url = "https://bridges.torproject.org/moat/circumvention/settings"
     headers = {"Content-type": "application/vnd.api+json"}
     data = {"country": country}
 
     try:
-        r = requests.get(url, json=data, proxies=proxy, headers=headers)
+        r = session.get(url, json=data, headers=headers, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
         r = r.json()
         r = r["settings"]
         if len(r):
@@ -177,7 +567,7 @@ def get_circumvention_bridges(country, network, snowflake):
             print(-2)
             sys.exit(1)
 
-    except requests.exceptions.ConnectionError:
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
         print(-1)
         sys.exit(1)
 
@@ -186,8 +576,22 @@ def get_circumvention_bridges(country, network, snowflake):
 @click.option('--network', '-n', default='', type=str, help="Force to get bridges over specific network. Example: -n <tor|inet>")
 @click.option('--country', '-c', default='', type=str, help="Circumvention country setting in lowercase")
 @click.option('--snowflake', is_flag=True, default=False, show_default=True, help="Get snowflake bridges instead of obfs4 (circumvention country need to be set)")
+@click.option('--attempts', default=ATTEMPTS, type=click.IntRange(min=1), show_default=True, help="Maximum number of captchas to solve")
+@click.option('--deadline', default=DEADLINE, type=click.IntRange(min=1), show_default=True, help="Maximum time in seconds to solve a captcha")
+@click.option('--parallel', default=PARALLEL, type=click.IntRange(min=1), show_default=True, help="Number of captchas in flight")
+@click.option('--stats', is_flag=True, default=False, help="Print the attempts, the success rate and the time per stage on stderr")
+@click.option('--ocr-benchmark', default=0, type=click.IntRange(min=0), help="Read this number of generated captchas with every available OCR engine and print the time per captcha")
+@click.option('--captcha-benchmark', default=None, type=click.Path(exists=True, file_okay=False), help="Read the captchas in this directory (named <text>.jpg) and print the accuracy and the time per stage")
+@click.option('--save-captchas', default=None, type=click.Path(file_okay=False), help="Save the captchas from moat in this directory (a corpus for --captcha-benchmark)")
 # fmt: on
-def main(network, country, snowflake):
+def main(network, country, snowflake, attempts, deadline, parallel, stats, ocr_benchmark, captcha_benchmark, save_captchas):
+    if ocr_benchmark:
+        benchmark_ocr(ocr_benchmark)
+        return
+    if captcha_benchmark is not None:
+        benchmark_captchas(captcha_benchmark)
+        return
+
     # Validate options
     if country:
         if len(country) > 2:
@@ -203,10 +607,19 @@ def main(network, country, snowflake):
         bridges = get_circumvention_bridges(country=country, network=network, snowflake=snowflake)
     # BridgeDB obfs4 bridges
     else:
-        bridges = get_bridges(network)
+        solve_stats = SolveStats()
+        bridges = get_bridges(network, attempts, deadline, parallel, solve_stats, save_captchas)
+        if stats:
+            solve_stats.report()
+        if not bridges:
+            bridges = ["-1"]
 
     print("\n".join(bridges))
 
+    # Don't wait for the captchas, which are still in flight
+    sys.stdout.flush()
+    os._exit(0)
+
 
 if __name__ == '__main__':
     main()
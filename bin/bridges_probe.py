@@ -0,0 +1,256 @@
+#!/usr/bin/python3
+
+# This file is part of TorBox, an easy to use anonymizing router based on Raspberry Pi.
+# Copyright (C) 2026 radio_24
+# Contact: anonym@torbox.ch
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it is useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# DESCRIPTION
+# This file checks, whether the bridges in torrc can be reached from our
+# network - Onionoo only knows, whether a bridge is running. For every bridge
+# it measures the time to open a TCP connection (directly, not over tor) and
+# prints the bridges ranked by this latency:
+# <latency in ms> <bridge line without "Bridge ">
+# Bridges, which couldn't be reached, follow with a latency of -1.
+#
+# An obfs4 bridge is reached on its address. The address of a snowflake
+# bridge is only a placeholder, therefore its front domains (or the host of
+# the broker) are reached on port 443.
+#
+# SYNTAX
+# ./bridges_probe.py [-f, --file <torrc>] [-t, --transport <obfs4|snowflake>] [-d, --deactivated] [-j, --jobs <number>] [-w, --timeout <seconds>]
+# ./bridges_probe.py [-t, --transport <obfs4|snowflake>] [-j, --jobs <number>] [-w, --timeout <seconds>] -b, --batch <file|->
+# ./bridges_probe.py --self-test
+#
+# -h, --help: print the help screen
+# -f, --file <torrc>: read the bridges from this file (default: /etc/tor/torrc)
+# -t, --transport <obfs4|snowflake>: only check bridges with this transport
+# -d, --deactivated: only check the deactivated bridges (#Bridge ...) in torrc
+# -b, --batch <file|->: read the bridge lines from a file or stdin instead of torrc
+# -j, --jobs <number>: number of parallel connections (default: 16)
+# -w, --timeout <seconds>: timeout of a connection (default: 5)
+# --self-test: probe bridges on local listeners (127.0.0.1) and check, that
+#              they are reached and the others are reported with -1
+
+import sys
+import time
+import getopt
+import socket
+
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+TORRC = '/etc/tor/torrc'
+TRANSPORTS = ('obfs4', 'snowflake')
+
+# Defaults for the number of parallel connections and their timeout (seconds)
+JOBS = 16
+TIMEOUT = 5
+
+
+# Splits "host:port" or "[IPv6]:port" - returns False, if the address is malformed
+def split_address(address, default_port=None):
+    host, sep, port = address.rpartition(':')
+    if not sep or (host.count(':') and not host.startswith('[')):
+        if default_port is None:
+            return False
+        host, port = address, default_port
+    try:
+        return host.strip('[]'), int(port)
+    except ValueError:
+        return False
+
+
+# Returns the bridge lines (without "Bridge " or "#Bridge ") of a torrc
+def read_bridges(lines, transport=None, deactivated=False):
+    bridges = []
+    for line in lines:
+        line = line.strip()
+        if line.startswith('#Bridge '):
+            line = line[len('#Bridge '):]
+        elif line.startswith('Bridge ') and not deactivated:
+            line = line[len('Bridge '):]
+        else:
+            continue
+        if line.split(' ', 1)[0] in ((transport,) if transport else TRANSPORTS):
+            bridges.append(line)
+    return bridges
+
+
+# Returns the (host, port) to connect to, for the bridge line
+def endpoints(bridge):
+    fields = bridge.split()
+    if fields[0] != 'snowflake':
+        address = split_address(fields[1]) if len(fields) > 1 else False
+        return [address] if address else []
+
+    options = dict(field.split('=', 1) for field in fields[2:] if '=' in field)
+    hosts = options.get('fronts', options.get('front', ''))
+    hosts = [host for host in hosts.split(',') if host]
+    if not hosts and options.get('url'):
+        hosts = [urlsplit(options['url']).netloc]
+    return [address for address in (split_address(host, 443) for host in hosts) if address]
+
+
+# Returns the time (seconds) to connect to the endpoint or None, if it can't be reached
+def connect(endpoint, timeout=TIMEOUT):
+    start = time.monotonic()
+    try:
+        with socket.create_connection(endpoint, timeout=timeout):
+            return time.monotonic() - start
+    except OSError:
+        return None
+
+
+# Returns the bridges with their latency (None, if they can't be reached), the fastest first
+def probe(bridges, jobs=JOBS, timeout=TIMEOUT):
+    # Many snowflake bridges share the same fronts - every endpoint is only reached once
+    targets = {bridge: endpoints(bridge) for bridge in bridges}
+    unique = sorted({endpoint for endpoint_list in targets.values() for endpoint in endpoint_list})
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        latencies = dict(zip(unique, executor.map(lambda endpoint: connect(endpoint, timeout), unique)))
+
+    results = []
+    for bridge, endpoint_list in targets.items():
+        reached = [latencies[endpoint] for endpoint in endpoint_list if latencies[endpoint] is not None]
+        results.append((bridge, min(reached) if reached else None))
+    results.sort(key=lambda result: (result[1] is None, result[1] or 0))
+    return results
+
+
+# Probes bridges on listeners on 127.0.0.1 and bridges, which can't be
+# reached (a closed port, a malformed address, a snowflake bridge without
+# front), and returns True, if they are ranked as expected
+def self_test(timeout=1):
+    listeners = []
+    for i in range(3):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen()
+        listeners.append(listener)
+    ports = [listener.getsockname()[1] for listener in listeners]
+    # A port, which was free a moment ago
+    with socket.socket() as closed:
+        closed.bind(('127.0.0.1', 0))
+        closed_port = closed.getsockname()[1]
+
+    fingerprint = '0' * 40
+    reachable = [f"obfs4 127.0.0.1:{port} {fingerprint} cert=test iat-mode=0" for port in ports[:2]]
+    reachable.append(f"snowflake 192.0.2.3:80 {fingerprint} fronts=127.0.0.1:{ports[2]}")
+    unreachable = [f"obfs4 127.0.0.1:{closed_port} {fingerprint} cert=test iat-mode=0",
+                   f"obfs4 127.0.0.1 {fingerprint} cert=test iat-mode=0",
+                   f"snowflake 192.0.2.4:80 {fingerprint}"]
+    try:
+        results = probe(unreachable + reachable, timeout=timeout)
+    finally:
+        for listener in listeners:
+            listener.close()
+
+    for bridge, latency in results:
+        print(f"{round(latency * 1000) if latency is not None else -1} {bridge}")
+    reached = [bridge for bridge, latency in results if latency is not None]
+    # The reachable bridges come first, the others are reported with -1
+    return sorted(reached) == sorted(reachable) and reached == [bridge for bridge, latency in results[:len(reached)]]
+
+
+def main():
+    try:
+        options, remainder = getopt.getopt(sys.argv[1:],
+                                           'f:t:db:j:w:h',
+                                           ['file=',
+                                            'transport=',
+                                            'deactivated',
+                                            'batch=',
+                                            'jobs=',
+                                            'timeout=',
+                                            'self-test',
+                                            'help'])
+    except getopt.GetoptError as e:
+        print(f"[X] {e}")
+        return
+
+    torrc = TORRC
+    transport = None
+    deactivated = False
+    batch_file = False
+    jobs = JOBS
+    timeout = TIMEOUT
+
+    for opt, arg in options:
+        if opt in ('-f', '--file'):
+            torrc = arg
+        elif opt in ('-t', '--transport'):
+            if arg not in TRANSPORTS:
+                print("[X] Invalid transport")
+                return
+            transport = arg
+        elif opt in ('-d', '--deactivated'):
+            deactivated = True
+        elif opt in ('-b', '--batch'):
+            batch_file = arg
+        elif opt in ('-j', '--jobs'):
+            try:
+                jobs = int(arg)
+            except ValueError:
+                print("[X] Invalid number of jobs")
+                return
+        elif opt in ('-w', '--timeout'):
+            try:
+                timeout = float(arg)
+            except ValueError:
+                print("[X] Invalid timeout")
+                return
+        elif opt == '--self-test':
+            if self_test():
+                print("[+] Self-test passed")
+            else:
+                print("[X] Self-test failed")
+                sys.exit(1)
+            return
+        elif opt in ('-h', '--help'):
+            print(f"Usage:\n {sys.argv[0]} [-f <torrc>] [-t <obfs4|snowflake>] [-d]\n {sys.argv[0]} -b <file|->\n {sys.argv[0]} --self-test\n\n"\
+                    "Options:\n"\
+                    " -f, --file=<torrc>\t\t\tRead the bridges from this file (default: /etc/tor/torrc)\n"\
+                    " -t, --transport=<obfs4|snowflake>\tOnly check bridges with this transport\n"\
+                    " -d, --deactivated\t\t\tOnly check the deactivated bridges\n"\
+                    " -b, --batch=<file|->\t\t\tRead the bridge lines from a file or stdin (- for stdin)\n"\
+                    " -j, --jobs=<number>\t\t\tNumber of parallel connections (default: 16)\n"\
+                    " -w, --timeout=<seconds>\t\tTimeout of a connection (default: 5)\n"\
+                    " --self-test\t\t\t\tProbe bridges on local listeners and check the ranking\n"\
+                    " -h, --help\t\t\t\tshow this help\n\n"\
+                    "Prints \"<latency in ms> <bridge>\" per bridge, the fastest first (-1: not reachable)\n")
+            return
+
+    try:
+        if batch_file == '-':
+            lines = sys.stdin.read().splitlines()
+        else:
+            with open(batch_file or torrc) as f:
+                lines = f.read().splitlines()
+    except OSError:
+        print("[X] Bridges can't be read")
+        return
+
+    if batch_file:
+        # Bridge lines with or without "Bridge "
+        lines = [line if line.lstrip('#').startswith('Bridge ') else f"Bridge {line}" for line in lines]
+    # --deactivated only applies to torrc
+    bridges = read_bridges(lines, transport, deactivated and not batch_file)
+    for bridge, latency in probe(bridges, jobs, timeout):
+        print(f"{round(latency * 1000) if latency is not None else -1} {bridge}")
+
+
+if __name__ == '__main__':
+    main()
@@ -20,85 +20,136 @@
 # DESCRIPTION
 # This will fetch the builtin bridges and display it alphabetically sorted.
 #
+# The bridges are cached in run/builtin_bridges.cache. Within --max-age, the
+# cached bridges are used without asking moat; afterwards, moat only sends
+# them again if they have changed (ETag). If moat can't be reached, the cached
+# bridges are used.
+#
+# --diff compares the bridges of the last fetch from moat with the ones of the
+# fetch before. If moat answered, that nothing has changed, nothing is printed.
+# Within --max-age, there is no new fetch and the same difference is printed.
+#
 # SYNTAX
-# ./catchbuiltinbridges.py [-n, --network=<tor|inet>] [--help]
+# ./catchbuiltinbridges.py [-n, --network=<tor|inet>] [-m, --max-age=<seconds>] [--diff] [--help]
 #
 # -n, --network=<tor|inet>: force check over specific network
+# -m, --max-age=<seconds>: use the cached bridges up to this age (default: 21600, 0: always ask moat)
+# --diff: print the bridges added (+) or removed (-) with the last fetch
 # --help              Show this message and exit.
 #
 # ERROR CODES:
 # -1: Network error
 
+import os
+import sys
+import json
+import time
 import click
-import requests
-
-# Try to get the builtin bridges through tor
-def get_proxy(network=''):
-    # Tor Socks Proxy
-    proxy = {
-        "http": "socks5h://127.0.0.1:9050",
-        "https": "socks5h://127.0.0.1:9050",
-    }
-
-    if not network:
-        # Check if Tor proxy is up, otherwise set inet network
-        try:
-            response = requests.get("https://bridges.torproject.org/moat/circumvention/builtin", proxies=proxy, timeout=5)
-        except:  # noqa
-            network = 'inet'
-
-    if network == "inet":
-        proxy = {
-            "http": "",
-            "https": "",
-        }
-    return proxy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'lib'))
+from torbox_network import get_session
+
+BUILTIN_URL = "https://bridges.torproject.org/moat/circumvention/builtin"
+
+# Timeouts (seconds) to connect and to wait for the answer
+CONNECT_TIMEOUT = 30
+READ_TIMEOUT = 60
+
+# The cached bridges and the default for the time (seconds) they are used without asking moat
+CACHE_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'run', 'builtin_bridges.cache')
+CACHE_TTL = 6*60*60
+
+
+def load_cache():
+    try:
+        with open(CACHE_FILE) as f:
+            cache = json.load(f)
+        # An error of moat may have been cached by an older version
+        cache['bridges'] = parse_bridges(cache['bridges'])
+        cache['previous'] = parse_bridges(cache['previous']) if cache.get('previous') else {}
+        return cache
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return {}
+
+
+def save_cache(cache):
+    try:
+        with open(CACHE_FILE + '.tmp', 'w') as f:
+            json.dump(cache, f)
+        os.replace(CACHE_FILE + '.tmp', CACHE_FILE)
+    except OSError:
+        pass
+
+
+# Returns the bridge lines of moat's answer ({"obfs4": [...], "snowflake": [...], ...}) by transport.
+# An error ({"errors": [{...}]}) or an answer without bridges raises a ValueError.
+def parse_bridges(data):
+    if not isinstance(data, dict):
+        raise ValueError("Unexpected answer")
+    bridges = {transport: sorted(lines) for transport, lines in data.items()
+               if isinstance(lines, list) and lines and all(isinstance(line, str) for line in lines)}
+    if not bridges:
+        raise ValueError("No bridges in the answer")
+    return bridges
+
+
+# Returns the cache with the current bridges or False on a network error without cached bridges
+def get_bridges(network, max_age=CACHE_TTL):
+    cache = load_cache()
+    if cache.get('bridges') and 0 <= time.time() - cache.get('fetched', 0) < max_age:
+        return cache
+
+    session = get_session(network)
+    headers = {'If-None-Match': cache['etag']} if cache.get('bridges') and cache.get('etag') else {}
+    try:
+        response = session.get(BUILTIN_URL, headers=headers, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+        # Any other answer is treated like a network error - nothing is cached
+        if response.status_code not in (200, 304):
+            raise ValueError(f"HTTP {response.status_code}")
+        bridges = cache['bridges'] if response.status_code == 304 else parse_bridges(response.json())
+        cache['previous'] = cache.get('bridges', {})
+        cache['bridges'] = bridges
+        if response.status_code == 200:
+            cache['etag'] = response.headers.get('ETag')
+    except (OSError, ValueError, AttributeError):
+        if not cache.get('bridges'):
+            return False
+        print("[!] moat can't be reached - using the cached bridges", file=sys.stderr)
+        return cache
+    cache['fetched'] = time.time()
+    save_cache(cache)
+    return cache
+
+
+def all_lines(bridges):
+    return {line for lines in bridges.values() for line in lines}
+
 
 # fmt: off
 @click.command()
 @click.option('--network', '-n', default='', type=str, help="Force to get bridges over specific network. Example: -n <tor|inet>")
+@click.option('--max-age', '-m', default=CACHE_TTL, type=int, show_default=True, help="Use the cached bridges up to this age in seconds (0: always ask moat)")
+@click.option('--diff', is_flag=True, default=False, help="Print the bridges added (+) or removed (-) with the last fetch")
 # fmt: on
 
 # Fetch the content from the URL
-def fetch_bridges(network):
-    proxy = get_proxy(network)
-
-    try:
-        response = requests.get("https://bridges.torproject.org/moat/circumvention/builtin", proxies=proxy)
-    except:
+def fetch_bridges(network, max_age, diff):
+    cache = get_bridges(network, max_age)
+    if not cache:
         print(-1)
         quit()
 
-    # Extract the information in the square brackets from the content
-    information = []
-    start_index = 0
-
-    # start_index returns the position of the first occurence until not found (-1)
-    while True:
-        start_index = response.text.find("[", start_index)
-        if start_index == -1:
-            break
-        end_index = response.text.find("]", start_index)
-        # Extract the text out of the brackets and creates a list
-        information.append(response.text[start_index:end_index + 1])
-        start_index = end_index + 1
-
-        # split the lines with commas into separate lines
-        lines = []
-        for info in information:
-            parts = info.split("[")[1].split("]")[0]
-            for part in parts.split("\",\""):
-                lines.append(part)
-
-        # Remove the quotation marks at the beginning and end of each line
-        lines = [line.strip('"') for line in lines]
-
-        # sort the lines
-        lines.sort()
-
-        # print the lines
-        for line in lines:
+    current = all_lines(cache['bridges'])
+    if diff:
+        previous = all_lines(cache.get('previous', {}))
+        for line in sorted(current - previous):
+            print(f"+ {line}")
+        for line in sorted(previous - current):
+            print(f"- {line}")
+    else:
+        for line in sorted(current):
             print(line)
 
+
 if __name__ == '__main__':
     fetch_bridges()
@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# This file is part of TorBox, an easy to use anonymizing router based on Raspberry Pi.
+# Copyright (C) 2026 radio_24
+# Contact: anonym@torbox.ch
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+# DESCRIPTION
+# This file contains the network functions shared by the bridge tools
+# (bridges_check.py, bridges_get.py and catchbuiltinbridges.py). They decide
+# whether to go over tor or the clearnet and hand out a pooled session.
+#
+# Whether tor is up is checked with a connection to its SOCKS port and a
+# SOCKS handshake only - no request goes over tor. The decision is cached in
+# run/torbox_network.cache for a short time, so that a menu calling several
+# tools only checks once. Tor may accept SOCKS connections long before it has
+# bootstrapped - therefore a session, which wasn't forced to a network, falls
+# back to the clearnet, if a request over tor fails, and the cached decision
+# is changed to 'inet'.
+
+import os
+import json
+import time
+import socket
+import requests
+from requests.adapters import HTTPAdapter
+
+# Tor Socks Proxy
+SOCKS_HOST = '127.0.0.1'
+SOCKS_PORT = 9050
+
+# Timeout (seconds) for the check of the SOCKS port
+PROBE_TIMEOUT = 3
+
+# The cached decision and the time (seconds) it is used
+NETWORK_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'run', 'torbox_network.cache')
+NETWORK_TTL = 300
+
+
+# Returns True, if tor accepts a SOCKS5 connection without authentication
+def probe_tor(host=SOCKS_HOST, port=SOCKS_PORT, timeout=PROBE_TIMEOUT):
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as s:
+            s.sendall(b'\x05\x01\x00')
+            return s.recv(2) == b'\x05\x00'
+    except OSError:
+        return False
+
+
+# Returns the network to use: 'tor' or 'inet' (a forced network is returned unchanged)
+def get_network(network=''):
+    if network:
+        return network
+
+    try:
+        with open(NETWORK_FILE) as f:
+            cache = json.load(f)
+        if 0 <= time.time() - cache['checked'] < NETWORK_TTL:
+            return cache['network']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    return set_network('tor' if probe_tor() else 'inet')
+
+
+# Caches the network to use - e.g. 'inet', if a request over tor failed
+def set_network(network):
+    try:
+        with open(NETWORK_FILE + '.tmp', 'w') as f:
+            json.dump({"network": network, "checked": time.time()}, f)
+        os.replace(NETWORK_FILE + '.tmp', NETWORK_FILE)
+    except OSError:
+        pass
+    return network
+
+
+def get_proxy(network=''):
+    if get_network(network) == 'inet':
+        return {
+            "http": "",
+            "https": "",
+        }
+    return {
+        "http": f"socks5h://{SOCKS_HOST}:{SOCKS_PORT}",
+        "https": f"socks5h://{SOCKS_HOST}:{SOCKS_PORT}",
+    }
+
+
+# A session over tor, which repeats a failed request over the clearnet and
+# then stays there
+class FallbackSession(requests.Session):
+    def request(self, method, url, **kwargs):
+        if self.proxies == get_proxy('inet'):
+            return super().request(method, url, **kwargs)
+        try:
+            return super().request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            self.proxies.update(get_proxy(set_network('inet')))
+            return super().request(method, url, **kwargs)
+
+
+# Returns a session, which keeps up to pool_size connections per host open.
+# Without network, the proxies have to be given with every request. With an
+# empty network, tor or the clearnet is chosen and a failed request over tor
+# is repeated over the clearnet.
+def get_session(network=None, pool_size=4):
+    session = FallbackSession() if network == '' and get_network() == 'tor' else requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if network is not None:
+        session.proxies.update(get_proxy(network))
+    return session
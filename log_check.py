@@ -23,71 +23,1092 @@
 # the sccript automat to automatically restor the tor functionality.
 # The script is configured by log_check_config.py
 #
+# Every log file is opened only once and followed by its byte offset. The
+# script sleeps until inotify reports a change in the directory of a log
+# file (or, if inotify is not available, until check_interval has passed)
+# and then only reads the newly appended lines. Truncation and rotation
+# (logrotate) of the log files are detected and handled. The commands are
+# executed in the background, so that the log files are still checked while
+# tor is restarted. Changes in log_check_config.py are applied without a
+# restart, as long as the changed configuration is valid. The positions in
+# the log files and the sliding windows are saved regularly and on SIGTERM,
+# so that log_check resumes where it stopped after a restart. Instead of a
+# log file, a rule can also follow the systemd journal of a unit. If
+# metrics_socket is configured, statistics about the processed lines, the
+# rules and the executed commands are available on this unix socket, e.g.:
+# sudo curl --unix-socket /run/log_check.sock http://localhost/metrics
+# sudo curl --unix-socket /run/log_check.sock http://localhost/json
+#
 # SYNTAX
-# sudo ./log_check.py &
+# sudo ./log_check.py [-c, --config <file>] [-b, --benchmark [<lines>]] [-r, --replay <log_file> [-s, --speed <factor>]] &
+#
+# -c, --config <file>: use another configuration file (default: log_check_config.py)
+# -b, --benchmark [<lines>]: measure the matcher on a synthetic notices.log
+#                            with <lines> lines (default: 1000000)
+# -r, --replay <log_file>: run a recorded log file through the rules without
+#                          executing commands and report which rules would
+#                          have fired and when
+# -s, --speed <factor>: replay at <factor> times real time (default: 0, as
+#                       fast as possible)
 
 import os
+import re
+import sys
+import json
 import time
+import runpy
+import random
+import select
+import signal
+import argparse
+import tempfile
+import socketserver
+import threading
 import subprocess
-import re
+import queue
+import ctypes
+import ctypes.util
 
+from collections import deque
 from datetime import datetime
-from log_check_config import config, matches
 
-for match in matches:
-    match['last_update'] = datetime.now().timestamp()
-    match['count'] = []
+# The configuration file of log_check
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'log_check_config.py')
+
+# inotify constants (see /usr/include/linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# With inotify, we nevertheless check the files from time to time (seconds)
+INOTIFY_TIMEOUT = 60
+
+# Number of lines used to measure the old, slow matching in the benchmark
+BENCHMARK_SAMPLE = 20000
+
+# Default for the file, in which the executed commands are logged
+ACTION_LOG = '/var/log/tor/log_check.log'
+
+# Default for the time a command is not executed again after it finished (seconds)
+ACTION_COOLDOWN = 60
+
+# Default for the time after which a command, which hasn't finished, is killed (seconds)
+ACTION_TIMEOUT = 600
+
+# Default for the file, in which log_check saves its position in the log
+# files and its sliding windows to resume after a restart
+STATE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run', 'log_check.state')
+
+# Default for the time between two saves of the state (seconds)
+STATE_INTERVAL = 60
+
+# Wait before journalctl is started again after it failed or ended (seconds)
+JOURNAL_RESTART = 10
+
+# Upper bounds of the buckets of the action duration histogram (seconds)
+DURATION_BUCKETS = [1, 5, 10, 30, 60, 120, 300, 600]
+
+# Month names used in the syslog-style prefix of the log lines
+MONTHS = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+          'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
+
+# A log line more than this in the future belongs to the last year (seconds)
+FUTURE_TOLERANCE = 24*60*60
+
+
+# Loads log_check_config.py and checks the rules. A malformed configuration
+# raises ValueError, so that a running log_check can keep its old rules.
+def load_config(path):
+    try:
+        namespace = runpy.run_path(path)
+    except Exception as e:
+        raise ValueError(f"{path} can't be loaded: {e}")
+
+    config = namespace.get('config')
+    rules = namespace.get('matches')
+    if not isinstance(config, dict):
+        raise ValueError("config has to be a dict")
+    interval = config.get('check_interval')
+    if not isinstance(interval, (int, float)) or interval <= 0:
+        raise ValueError("check_interval has to be a positive number")
+    if not isinstance(rules, list):
+        raise ValueError("matches has to be a list")
+
+    for i, m in enumerate(rules):
+        if not isinstance(m, dict):
+            raise ValueError(f"Rule {i} has to be a dict")
+        for key in ('match', 'command'):
+            if not isinstance(m.get(key), str) or not m[key]:
+                raise ValueError(f"Rule {i}: {key} has to be a non-empty string")
+        source = m.get('journal', m.get('file'))
+        if not isinstance(source, str) or not source:
+            raise ValueError(f"Rule {i}: file or journal has to be a non-empty string")
+        if not isinstance(m.get('match_count'), int) or m['match_count'] < 1:
+            raise ValueError(f"Rule {i}: match_count has to be a positive integer")
+        if not isinstance(m.get('match_time'), (int, float)) or m['match_time'] < 0:
+            raise ValueError(f"Rule {i}: match_time has to be a number >= 0")
+        if not isinstance(m.get('cooldown', 0), (int, float)) or m.get('cooldown', 0) < 0:
+            raise ValueError(f"Rule {i}: cooldown has to be a number >= 0")
+
+    return config, rules
+
+
+# A rule reads either a log file ("file") or the journal of a systemd unit
+# ("journal"). The rules of the same source share one reader.
+def source_of(m):
+    if m.get('journal'):
+        return f"journal:{m['journal']}"
+    return m['file']
+
+
+# Follows one log file by its byte offset and returns only new lines
+class FileTailer:
+    def __init__(self, path):
+        self.path = path
+        self.fh = None
+        self.inode = None
+        self.offset = 0
+        self.buffer = b''
+        # Like "tail -f": we start at the end of an already existing file
+        self.open(seek_end=True)
+
+    def open(self, seek_end=False):
+        try:
+            fh = open(self.path, 'rb')
+        except OSError:
+            return False
+        st = os.fstat(fh.fileno())
+        self.fh = fh
+        self.inode = (st.st_dev, st.st_ino)
+        self.offset = st.st_size if seek_end else 0
+        self.buffer = b''
+        fh.seek(self.offset)
+        return True
+
+    # Continues at the position of a former run, if it is still the same file.
+    # If the file was rotated in the meantime, the new file is read completely.
+    def resume(self, position):
+        if self.fh is None:
+            return
+        offset = position['offset']
+        if self.inode[1] != position['inode']:
+            offset = 0
+        elif offset > os.fstat(self.fh.fileno()).st_size:
+            return
+        self.fh.seek(offset)
+        self.offset = offset
+        self.buffer = b''
+
+    # The position after the last complete line
+    def position(self):
+        if self.fh is None:
+            return None
+        return {"inode": self.inode[1], "offset": self.offset - len(self.buffer)}
+
+    # Changes are noticed by the LogWatcher with inotify
+    def fileno(self):
+        return None
+
+    # Bytes written to the file, but not read yet
+    def lag(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return 0
+        if self.fh is None or (st.st_dev, st.st_ino) != self.inode:
+            return st.st_size
+        return max(0, st.st_size - self.offset)
+
+    def close(self):
+        if self.fh:
+            self.fh.close()
+
+    def read(self):
+        data = self.fh.read()
+        if not data:
+            return []
+        self.offset += len(data)
+        lines = (self.buffer + data).split(b'\n')
+        # The last element is an incomplete line (or empty)
+        self.buffer = lines.pop()
+        return [line.decode('utf-8', 'replace') for line in lines]
+
+    def read_lines(self):
+        # The file didn't exist so far (a new file is read from the beginning)
+        if self.fh is None:
+            if not self.open():
+                return []
 
-while True:
-    for m in matches:
-        file = m['file']
-        match = re.escape(m['match'])
-        match_count = m['match_count']
-        match_time = m['match_time']
-        match_cmd = m['command']
+        # The file was truncated in place (logrotate with copytruncate)
+        if os.fstat(self.fh.fileno()).st_size < self.offset:
+            self.fh.seek(0)
+            self.offset = 0
+            self.buffer = b''
 
-        c = ["tail", "-n", "100", file]
-        output = subprocess.check_output(c).decode('utf-8')
+        lines = self.read()
 
-        for line in output.split("\n"):
-            if not line:
+        # The file was rotated - finish the old one and continue with the new one
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return lines
+        if (st.st_dev, st.st_ino) != self.inode:
+            if self.buffer:
+                lines.append(self.buffer.decode('utf-8', 'replace'))
+            self.fh.close()
+            self.fh = None
+            if self.open():
+                lines.extend(self.read())
+        return lines
+
+    # Log files have no structured timestamp - it is parsed from the line
+    def read_entries(self):
+        return [(None, line) for line in self.read_lines()]
+
+
+# Follows the systemd journal of one unit with journalctl. The entries have
+# structured timestamps and the position is kept as journal cursor.
+class JournalSource:
+    def __init__(self, unit):
+        self.unit = unit
+        self.cursor = None
+        self.proc = None
+        self.buffer = b''
+        self.started = None
+
+    def start(self):
+        # Don't try to restart a failing journalctl all the time
+        if self.started is not None and time.monotonic() - self.started < JOURNAL_RESTART:
+            return
+        self.started = time.monotonic()
+        # Like "tail -f": without a cursor, we start with the next entry
+        cmd = ['journalctl', '--follow', '--output=json', f'--unit={self.unit}']
+        cmd.append(f'--after-cursor={self.cursor}' if self.cursor else '--lines=0')
+        try:
+            self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            print(f"[X] journalctl can't be started: {e}")
+            return
+        os.set_blocking(self.proc.stdout.fileno(), False)
+        self.buffer = b''
+
+    def resume(self, position):
+        self.close()
+        self.cursor = position.get('cursor')
+        self.started = None
+
+    def position(self):
+        if self.cursor is None:
+            return None
+        return {"cursor": self.cursor}
+
+    def fileno(self):
+        return self.proc.stdout.fileno() if self.proc else None
+
+    # The journal has no byte offset
+    def lag(self):
+        return None
+
+    def close(self):
+        if self.proc:
+            self.proc.terminate()
+            self.proc.wait()
+            self.proc = None
+
+    def read_entries(self):
+        if self.proc is None:
+            self.start()
+            if self.proc is None:
+                return []
+
+        chunks = []
+        try:
+            while True:
+                chunk = os.read(self.proc.stdout.fileno(), 65536)
+                if not chunk:
+                    # journalctl ended - it is restarted after the cursor
+                    self.close()
+                    break
+                chunks.append(chunk)
+        except BlockingIOError:
+            pass
+
+        lines = (self.buffer + b''.join(chunks)).split(b'\n')
+        self.buffer = lines.pop()
+        entries = []
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
                 continue
+            self.cursor = entry.get('__CURSOR', self.cursor)
+            message = entry.get('MESSAGE')
+            # Messages with non-printable characters are delivered as byte array
+            if isinstance(message, list):
+                message = bytes(message).decode('utf-8', 'replace')
+            if not isinstance(message, str):
+                continue
+            try:
+                ts = int(entry['__REALTIME_TIMESTAMP']) / 1000000
+            except (KeyError, ValueError):
+                continue
+            entries.append((ts, message))
+        return entries
+
+
+# Waits until one of the watched files could have changed
+class LogWatcher:
+    def __init__(self):
+        self.fd = None
+        self.libc = None
+        self.directories = set()
+        self.complete = True
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self.fd = fd
+                self.libc = libc
+        except (OSError, AttributeError):
+            # No inotify available - fall back to polling
+            self.fd = None
+
+    # We watch the directories to also notice a rotation of the files
+    def watch(self, path):
+        directory = os.path.dirname(os.path.abspath(path))
+        if directory in self.directories:
+            return
+        mask = IN_MODIFY | IN_CREATE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+        if self.fd is None or self.libc.inotify_add_watch(self.fd, directory.encode(), mask) < 0:
+            # For example, the directory doesn't exist - fall back to polling
+            self.complete = False
+            return
+        self.directories.add(directory)
+
+    # Sources without a file (e.g. the journal) are watched by their fileno()
+    def wait(self, check_interval, sources=()):
+        fds = [fd for fd in (source.fileno() for source in sources) if fd is not None]
+        if self.fd is None or not self.complete:
+            timeout = check_interval
+        else:
+            fds.append(self.fd)
+            timeout = INOTIFY_TIMEOUT
+        if not fds:
+            select.select([], [], [], timeout)
+            return
+        ready, _, _ = select.select(fds, [], [], timeout)
+        if self.fd in ready:
+            # We are only interested in the wake-up, not in the events themselves
+            try:
+                while os.read(self.fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+        if ready:
+            # Give the writer the chance to finish a burst of lines
+            select.select([], [], [], check_interval)
+
+
+# Parses the 15 characters long prefix of a log line ("Oct 18 10:00:00").
+# All lines written within the same second share the same prefix, therefore
+# the last prefix and its timestamp are memorized.
+class TimestampParser:
+    def __init__(self):
+        self.last_prefix = None
+        self.last_ts = None
+
+    def parse(self, line, now=None):
+        prefix = line[:15]
+        if prefix == self.last_prefix:
+            return self.last_ts
+
+        try:
+            if prefix[3] != ' ' or prefix[6] != ' ' or prefix[9] != ':' or prefix[12] != ':':
+                return None
+            month = MONTHS[prefix[:3]]
+            day = int(prefix[4:6])
+            hour = int(prefix[7:9])
+            minute = int(prefix[10:12])
+            second = int(prefix[13:15])
+        except (IndexError, KeyError, ValueError):
+            return None
+        if not (1 <= day <= 31 and hour < 24 and minute < 60 and second < 62):
+            return None
+
+        # The prefix has no year. A line from December read in January
+        # belongs to the last year and must not become a future timestamp.
+        if now is None:
+            now = time.time()
+        year = time.localtime(now).tm_year
+        ts = time.mktime((year, month, day, hour, minute, second, 0, 0, -1))
+        if ts > now + FUTURE_TOLERANCE:
+            ts = time.mktime((year - 1, month, day, hour, minute, second, 0, 0, -1))
+
+        self.last_prefix = prefix
+        self.last_ts = ts
+        return ts
+
+
+# Translates a rule with * as wildcard into a regular expression
+def wildcard_to_regex(match):
+    return '.*?'.join(re.escape(part) for part in match.strip('*').split('*'))
+
+
+# All rules of one log file compiled into one regular expression, so that
+# every line is scanned only once. Lines which satisfy at least one rule are
+# dispatched with a second expression, which contains one named group per rule.
+class RuleMatcher:
+    def __init__(self, rules):
+        self.rules = list(rules)
+        patterns = [wildcard_to_regex(m['match']) for m in self.rules]
+        self.prefilter = re.compile('|'.join(f"(?:{p})" for p in patterns))
+        self.dispatch = re.compile(''.join(f"(?:(?=.*?(?P<r{i}>{p})))?" for i, p in enumerate(patterns)))
+
+    def match(self, line):
+        if not self.rules or not self.prefilter.search(line):
+            return []
+        if len(self.rules) == 1:
+            return self.rules
+        groups = self.dispatch.match(line).groups()
+        return [m for m, g in zip(self.rules, groups) if g is not None]
+
 
-            # only process lines with right format
+# The timestamps of the last matches of one rule. Matches older than
+# match_time are evicted as new ones arrive, and never more than match_count
+# timestamps are kept.
+class SlidingWindow:
+    def __init__(self, match_count, match_time):
+        self.match_time = match_time
+        self.events = deque(maxlen=max(1, match_count))
+
+    # Returns True as soon as match_count matches are within match_time
+    def add(self, ts):
+        self.events.append(ts)
+        while ts - self.events[0] > self.match_time:
+            self.events.popleft()
+        if len(self.events) == self.events.maxlen:
+            self.events.clear()
+            return True
+        return False
+
+
+# Counters of log_check, shown on the optional metrics socket. They are kept
+# by source and match, so that they survive a reload of the configuration.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.lines = {}
+        self.rate_samples = deque(maxlen=60)
+        self.matches = {}
+        self.fires = {}
+        self.last_fire = {}
+        self.actions = {}
+
+    # The lines are counted by the main thread and read by the metrics server
+    def count_lines(self, key, count):
+        now = time.monotonic()
+        with self.lock:
+            if not self.rate_samples or now - self.rate_samples[-1][0] >= 1:
+                self.rate_samples.append((now, sum(self.lines.values())))
+            self.lines[key] = self.lines.get(key, 0) + count
+
+    def count_match(self, m):
+        key = (source_of(m), m['match'])
+        self.matches[key] = self.matches.get(key, 0) + 1
+
+    def count_fire(self, m):
+        key = (source_of(m), m['match'])
+        self.fires[key] = self.fires.get(key, 0) + 1
+        self.last_fire[key] = time.monotonic()
+
+    def action(self, cmd):
+        if cmd not in self.actions:
+            self.actions[cmd] = {"executions": 0, "failures": 0, "skipped": 0, "duration_sum": 0.0,
+                                 "duration_buckets": [0] * len(DURATION_BUCKETS)}
+        return self.actions[cmd]
+
+    def count_skipped(self, cmd):
+        with self.lock:
+            self.action(cmd)['skipped'] += 1
+
+    def observe_action(self, cmd, returncode, duration):
+        with self.lock:
+            action = self.action(cmd)
+            action['executions'] += 1
+            if returncode != 0:
+                action['failures'] += 1
+            action['duration_sum'] += duration
+            for i, le in enumerate(DURATION_BUCKETS):
+                if duration <= le:
+                    action['duration_buckets'][i] += 1
+
+    # Average over the last minute with lines (at least over one second)
+    def lines_per_second(self):
+        with self.lock:
+            if not self.rate_samples:
+                return 0.0
+            t0, n0 = self.rate_samples[0]
+            return (sum(self.lines.values()) - n0) / max(1, time.monotonic() - t0)
+
+    def stats(self, logcheck):
+        now = time.monotonic()
+        sources = {}
+        with self.lock:
+            lines = dict(self.lines)
+        for key, source in list(logcheck.sources.items()):
+            sources[key] = {"lines": lines.get(key, 0), "lag_bytes": source.lag()}
+        rules = []
+        for m in list(logcheck.rules):
+            key = (source_of(m), m['match'])
+            last_fire = self.last_fire.get(key)
+            rules.append({
+                "source": key[0],
+                "match": key[1],
+                "matches": self.matches.get(key, 0),
+                "fires": self.fires.get(key, 0),
+                "seconds_since_last_fire": round(now - last_fire, 3) if last_fire else None,
+            })
+        with self.lock:
+            actions = {cmd: dict(a, duration_buckets=list(a['duration_buckets'])) for cmd, a in self.actions.items()}
+        return {
+            "uptime": round(now - self.started, 3),
+            "lines_per_second": round(self.lines_per_second(), 3),
+            "sources": sources,
+            "rules": rules,
+            "actions": actions,
+        }
+
+
+# Formats the statistics in the Prometheus text format
+def prometheus_text(stats):
+    def label(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    out = [
+        "# TYPE log_check_uptime_seconds gauge",
+        f"log_check_uptime_seconds {stats['uptime']}",
+        "# TYPE log_check_lines_per_second gauge",
+        f"log_check_lines_per_second {stats['lines_per_second']}",
+        "# TYPE log_check_lines_total counter",
+    ]
+    for key, source in stats['sources'].items():
+        out.append(f'log_check_lines_total{{source="{label(key)}"}} {source["lines"]}')
+    out.append("# TYPE log_check_lag_bytes gauge")
+    for key, source in stats['sources'].items():
+        if source['lag_bytes'] is not None:
+            out.append(f'log_check_lag_bytes{{source="{label(key)}"}} {source["lag_bytes"]}')
+    out.append("# TYPE log_check_rule_matches_total counter")
+    for rule in stats['rules']:
+        out.append(f'log_check_rule_matches_total{{source="{label(rule["source"])}",match="{label(rule["match"])}"}} {rule["matches"]}')
+    out.append("# TYPE log_check_rule_fires_total counter")
+    for rule in stats['rules']:
+        out.append(f'log_check_rule_fires_total{{source="{label(rule["source"])}",match="{label(rule["match"])}"}} {rule["fires"]}')
+    out.append("# TYPE log_check_rule_seconds_since_last_fire gauge")
+    for rule in stats['rules']:
+        if rule['seconds_since_last_fire'] is not None:
+            out.append(f'log_check_rule_seconds_since_last_fire{{source="{label(rule["source"])}",match="{label(rule["match"])}"}} {rule["seconds_since_last_fire"]}')
+    out.append("# TYPE log_check_action_failures_total counter")
+    for cmd, action in stats['actions'].items():
+        out.append(f'log_check_action_failures_total{{command="{label(cmd)}"}} {action["failures"]}')
+    out.append("# TYPE log_check_action_skipped_total counter")
+    for cmd, action in stats['actions'].items():
+        out.append(f'log_check_action_skipped_total{{command="{label(cmd)}"}} {action["skipped"]}')
+    out.append("# TYPE log_check_action_duration_seconds histogram")
+    for cmd, action in stats['actions'].items():
+        for le, count in zip(DURATION_BUCKETS, action['duration_buckets']):
+            out.append(f'log_check_action_duration_seconds_bucket{{command="{label(cmd)}",le="{le}"}} {count}')
+        out.append(f'log_check_action_duration_seconds_bucket{{command="{label(cmd)}",le="+Inf"}} {action["executions"]}')
+        out.append(f'log_check_action_duration_seconds_sum{{command="{label(cmd)}"}} {round(action["duration_sum"], 3)}')
+        out.append(f'log_check_action_duration_seconds_count{{command="{label(cmd)}"}} {action["executions"]}')
+    return "\n".join(out) + "\n"
+
+
+# Answers on the metrics socket. A request containing "json" (for example
+# "GET /json" or just "json") gets JSON, everything else the Prometheus text
+# format. HTTP requests (curl --unix-socket) get an HTTP response.
+class MetricsHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.request.settimeout(1)
+        try:
+            request = self.rfile.readline(1024).decode('ascii', 'replace')
+        except OSError:
+            request = ''
+        stats = self.server.metrics.stats(self.server.logcheck)
+        if 'json' in request:
+            body = json.dumps(stats, indent=2) + "\n"
+            content_type = 'application/json'
+        else:
+            body = prometheus_text(stats)
+            content_type = 'text/plain; version=0.0.4'
+        body = body.encode()
+        if request.startswith('GET '):
+            header = f"HTTP/1.0 200 OK\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n\r\n"
+            body = header.encode() + body
+        try:
+            self.wfile.write(body)
+        except OSError:
+            pass
+
+
+class MetricsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, metrics, logcheck):
+        self.metrics = metrics
+        self.logcheck = logcheck
+        # A socket of a former run has to be removed before binding
+        if os.path.exists(path):
+            os.unlink(path)
+        super().__init__(path, MetricsHandler)
+        os.chmod(path, 0o660)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+# Runs the commands of the fired rules in the background, so that the log
+# files are still checked while, for example, bin/automat restarts tor.
+# The commands are executed one after another by one worker thread - two
+# different calls of bin/automat must not restart tor at the same time. A
+# command, which is already queued or running, isn't queued again, and it is
+# not started again within its cooldown after it finished. A command, which
+# hangs, is killed after the timeout. Every execution is written as one JSON
+# line into the action log.
+class ActionExecutor:
+    def __init__(self, log_file, cooldown, metrics=None, timeout=ACTION_TIMEOUT):
+        self.log_file = log_file
+        self.cooldown = cooldown
+        self.timeout = timeout
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        # The queued and the running commands
+        self.pending = set()
+        self.queue = queue.Queue()
+        self.last_end = {}
+        threading.Thread(target=self.work, daemon=True).start()
+
+    def submit(self, cmd, cooldown=None):
+        if cooldown is None:
+            cooldown = self.cooldown
+        with self.lock:
+            if cmd in self.pending or time.time() - self.last_end.get(cmd, 0) < cooldown:
+                if self.metrics:
+                    self.metrics.count_skipped(cmd)
+                return False
+            self.pending.add(cmd)
+        self.queue.put(cmd)
+        return True
+
+    def work(self):
+        while True:
+            self.run(self.queue.get())
+
+    def run(self, cmd):
+        started = time.time()
+        t0 = time.monotonic()
+        timed_out = False
+        try:
+            # In its own process group, so that the commands started by the shell are killed as well
+            proc = subprocess.Popen(cmd, shell=True, start_new_session=True)
             try:
-                dts = line[:15]  # :15 length of date in linux logs
-                dts = f"{datetime.now().year} {dts}"
-                d = datetime.strptime(dts, '%Y %b %d %H:%M:%S')
-                line_ts = d.timestamp()
-            except:
+                returncode = proc.wait(timeout=self.timeout)
+            except subprocess.TimeoutExpired:
+                timed_out = True
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                returncode = proc.wait()
+                print(f"[X] {cmd} didn't finish within {self.timeout} seconds and was killed")
+        except OSError:
+            returncode = -1
+        duration = time.monotonic() - t0
+        if self.metrics:
+            self.metrics.observe_action(cmd, returncode, duration)
+
+        with self.lock:
+            self.pending.discard(cmd)
+            self.last_end[cmd] = time.time()
+            entry = {
+                "started": datetime.fromtimestamp(started).isoformat(timespec='seconds'),
+                "command": cmd,
+                "returncode": returncode,
+                "duration": round(duration, 3),
+                "timed_out": timed_out,
+            }
+            try:
+                with open(self.log_file, 'a') as fh:
+                    fh.write(json.dumps(entry) + "\n")
+            except OSError:
+                pass
+
+
+# The log watchdog. The configuration file is watched as well and reloaded
+# when it changes - the rules are replaced only if the new file is valid.
+class LogCheck:
+    def __init__(self, config_file, config, rules):
+        self.config_file = config_file
+        self.config_stat = self.stat_config()
+        self.config = {}
+        self.rules = []
+        self.sources = {}
+        self.matchers = {}
+        self.watcher = LogWatcher()
+        self.watcher.watch(config_file)
+        self.parser = TimestampParser()
+        self.metrics = Metrics()
+        self.metrics_server = None
+        self.executor = ActionExecutor(ACTION_LOG, ACTION_COOLDOWN, self.metrics)
+        self.apply(config, rules)
+        self.state_saved = time.monotonic()
+        # By source: matched lines of the first read after a restart, which
+        # are older than this, are ignored (see load_state)
+        self.not_before = {}
+        self.load_state()
+
+    def stat_config(self):
+        try:
+            st = os.stat(self.config_file)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    # Activates a new set of rules. Rules with the same source and match keep
+    # the matches in their window, even if their thresholds changed.
+    def apply(self, config, rules):
+        old_windows = {(source_of(m), m['match']): m['window'] for m in self.rules}
+        for m in rules:
+            m['window'] = SlidingWindow(m['match_count'], m['match_time'])
+            old_window = old_windows.get((source_of(m), m['match']))
+            if old_window:
+                m['window'].events.extend(old_window.events)
+
+        sources = {}
+        matchers = {}
+        for m in rules:
+            key = source_of(m)
+            if key in sources:
                 continue
+            if key in self.sources:
+                sources[key] = self.sources[key]
+            elif m.get('journal'):
+                sources[key] = JournalSource(m['journal'])
+            else:
+                sources[key] = FileTailer(m['file'])
+                self.watcher.watch(m['file'])
+        for key in sources:
+            matchers[key] = RuleMatcher([m for m in rules if source_of(m) == key])
+        for key, source in self.sources.items():
+            if key not in sources:
+                source.close()
+
+        self.config = config
+        self.rules = rules
+        self.sources = sources
+        self.matchers = matchers
+        self.executor.log_file = config.get('action_log', ACTION_LOG)
+        self.executor.cooldown = config.get('action_cooldown', ACTION_COOLDOWN)
+        self.executor.timeout = config.get('action_timeout', ACTION_TIMEOUT)
+        self.start_metrics(config.get('metrics_socket'))
 
-            if m['last_update'] < line_ts:
-                m['last_update'] = line_ts
-                match_re = match.replace('\*', '(.*)')
+    # The metrics socket is optional and (re)started when its path changes
+    def start_metrics(self, path):
+        if self.metrics_server:
+            if self.metrics_server.server_address == path:
+                return
+            self.metrics_server.close()
+            self.metrics_server = None
+        if not path:
+            return
+        try:
+            self.metrics_server = MetricsServer(path, self.metrics, self)
+        except OSError as e:
+            print(f"[X] Metrics socket {path} can't be opened: {e}")
 
+    def reload(self):
+        config_stat = self.stat_config()
+        if config_stat == self.config_stat:
+            return
+        self.config_stat = config_stat
+        try:
+            config, rules = load_config(self.config_file)
+        except ValueError as e:
+            print(f"[X] Configuration not reloaded: {e}")
+            return
+        self.apply(config, rules)
+        print(f"[+] Configuration reloaded: {len(rules)} rules")
+
+    # Restores the positions in the log files, the sliding windows and the
+    # last executions of the commands of a former run. log_check may have been
+    # stopped for days: matches, which are older than match_time, can't fire
+    # a rule anymore - they are dropped from the windows, and lines written
+    # before the largest match_time are read, but not matched. This only
+    # applies to the lines read up to the first time after the restart - a
+    # clock set back later mustn't hide new lines.
+    def load_state(self):
+        try:
+            with open(self.config.get('state_file', STATE_FILE)) as fh:
+                state = json.load(fh)
+        except (OSError, ValueError):
+            return
+
+        now = time.time()
+        for key, position in state.get('sources', {}).items():
+            if key in self.sources and position:
+                self.sources[key].resume(position)
+                self.not_before[key] = now - max(m['match_time'] for m in self.rules if source_of(m) == key)
+        windows = {(w.get('source'), w.get('match')): w.get('events', []) for w in state.get('windows', [])}
+        for m in self.rules:
+            events = windows.get((source_of(m), m['match']), [])
+            m['window'].events.extend(ts for ts in events if now - ts <= m['match_time'])
+        self.executor.last_end.update(state.get('actions', {}))
+
+    def save_state(self):
+        state = {
+            "sources": {key: source.position() for key, source in self.sources.items()},
+            "windows": [{"source": source_of(m), "match": m['match'], "events": list(m['window'].events)} for m in self.rules],
+            "actions": dict(self.executor.last_end),
+        }
+        state_file = self.config.get('state_file', STATE_FILE)
+        try:
+            with open(state_file + '.tmp', 'w') as fh:
+                json.dump(state, fh)
+            os.replace(state_file + '.tmp', state_file)
+        except OSError as e:
+            print(f"[X] State not saved: {e}")
+        self.state_saved = time.monotonic()
+
+    def check_line(self, m, line_ts):
+        self.metrics.count_match(m)
+        if m['window'].add(line_ts):
+            self.metrics.count_fire(m)
+            # We're in time, execute command
+            self.executor.submit(m['command'], m.get('cooldown'))
+            # Don't fire again for the same lines after a crash
+            self.save_state()
+
+    def run(self):
+        # pkill sends SIGTERM - leave the loop, so that the state is saved
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            self.loop()
+        finally:
+            self.save_state()
+            for source in self.sources.values():
+                source.close()
+            if self.metrics_server:
+                self.metrics_server.close()
+
+    def loop(self):
+        while True:
+            for key, source in self.sources.items():
+                entries = source.read_entries()
+                not_before = None
+                if entries:
+                    self.metrics.count_lines(key, len(entries))
+                    not_before = self.not_before.pop(key, None)
+                for line_ts, line in entries:
+                    if not line:
+                        continue
+                    fired = self.matchers[key].match(line)
+                    if not fired:
+                        continue
+                    # only process lines with right format
+                    if line_ts is None:
+                        line_ts = self.parser.parse(line)
+                        if line_ts is None:
+                            continue
+                    # A line from before the restart, which is too old to fire a rule
+                    if not_before is not None and line_ts < not_before:
+                        continue
+                    for m in fired:
+                        self.check_line(m, line_ts)
+
+            if time.monotonic() - self.state_saved >= self.config.get('state_interval', STATE_INTERVAL):
+                self.save_state()
+            self.watcher.wait(self.config['check_interval'], self.sources.values())
+            self.reload()
+
+
+# Measures the matcher with a growing number of rules on a synthetic log
+def benchmark(matches, num_lines):
+    noise = [
+        "[notice] Bootstrapped 100% (done): Done",
+        "[notice] Heartbeat: Tor's uptime is 2 days 3:00 hours, with 12 circuits open. I've sent 98.21 MB and received 1.04 GB.",
+        "[notice] New control connection opened from 127.0.0.1.",
+        "[warn] Problem bootstrapping. Stuck at 10% (conn_done): Connected to a relay. (DONE; DONE; count 1; recommendation warn)",
+        "[notice] Our directory information is no longer up-to-date enough to build circuits: We're missing descriptors for 1/2 of our primary entry guards",
+    ]
+    hits = [
+        "[notice] We tried for 15 seconds to connect to '[scrubbed]' using exit $ABCDEF at 1.2.3.4. Retrying on a new circuit.",
+        "[warn] Tried for 120 seconds to get a connection to [scrubbed]:443. Giving up.",
+        "[warn] 60 connections have failed: 60 connections died in state connect()ing with SSL state (No SSL object)",
+        "[warn] Failed to find node for hop #2 of our path. Discarding this circuit.",
+    ]
+
+    # Write the synthetic notices.log
+    random.seed(0)
+    log_file = os.path.join(tempfile.mkdtemp(), 'notices.log')
+    start = time.mktime((2026, 10, 18, 0, 0, 0, 0, 0, -1))
+    with open(log_file, 'w') as fh:
+        for i in range(num_lines):
+            text = random.choice(hits) if random.random() < 0.01 else random.choice(noise)
+            ts = time.strftime('%b %d %H:%M:%S', time.localtime(start + i // 100))
+            fh.write(f"{ts}.000 {text}\n")
+    with open(log_file) as fh:
+        lines = fh.read().splitlines()
+    os.unlink(log_file)
+    os.rmdir(os.path.dirname(log_file))
+    print(f"Synthetic log with {len(lines)} lines")
+
+    # Timestamp parsing with strptime, as log_check did before
+    t0 = time.perf_counter()
+    for line in lines[:BENCHMARK_SAMPLE * 10]:
+        dts = f"{datetime.now().year} {line[:15]}"
+        datetime.strptime(dts, '%Y %b %d %H:%M:%S').timestamp()
+    t_strptime = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    parser = TimestampParser()
+    for line in lines:
+        parser.parse(line)
+    t_parser = time.perf_counter() - t0
+    print(f"Timestamps: strptime {min(len(lines), BENCHMARK_SAMPLE * 10) / t_strptime:10.0f} lines/s, "
+          f"parser {len(lines) / t_parser:10.0f} lines/s")
+
+    rules = [{"match": m['match']} for m in matches]
+    for i in range(len(rules), 50):
+        rules.append({"match": f"*synthetic rule {i} did not * match*"})
+
+    for num_rules in sorted({1, 5, len(matches), 20, 50}):
+        subset = rules[:num_rules]
+
+        # One re.search per line and rule, as log_check did before (this is
+        # slow, therefore it is only measured on a sample of the lines)
+        sample = lines[:BENCHMARK_SAMPLE]
+        t0 = time.perf_counter()
+        fired_single = 0
+        for line in sample:
+            for m in subset:
+                match_re = re.escape(m['match']).replace('\\*', '(.*)')
                 if re.search(match_re, line):
-                    match_info = {
-                            "ts": line_ts,
-                            "line": line
-                        }
-                    m['count'].append(match_info)
-
-                    if len(m['count']) >= m['match_count']:
-                        # Check if we are in time
-                        ts_ini = m['count'][0]['ts']
-                        ts_end = m['count'][match_count-1]['ts']
-                        ts_diff = ts_end - ts_ini
-
-                        if ts_diff <= match_time:
-                            # We're in time, execute command
-                            os.system(match_cmd)
-                            m['count'] = []
-                        else:
-                            # We are outside of time, reset and count current
-                            m['count'] = []
-                            m['count'].append(match_info)
-
-
-
-    time.sleep(config['check_interval'])
+                    fired_single += 1
+        t_single = time.perf_counter() - t0
+
+        # One combined matcher
+        t0 = time.perf_counter()
+        matcher = RuleMatcher(subset)
+        fired_combined = 0
+        for line in lines:
+            fired_combined += len(matcher.match(line))
+        t_combined = time.perf_counter() - t0
+
+        if fired_single != sum(len(matcher.match(line)) for line in sample):
+            print(f"[X] Matcher mismatch with {num_rules} rules")
+        print(f"{num_rules:3d} rules: per rule {len(sample) / t_single:10.0f} lines/s, "
+              f"combined {len(lines) / t_combined:10.0f} lines/s ({fired_combined} matches)")
+
+
+# Runs a recorded log file through the rules without executing the commands.
+# The cooldown is simulated with the timestamps of the log lines.
+def replay(config, rules, log_file, speed):
+    for m in rules:
+        m['window'] = SlidingWindow(m['match_count'], m['match_time'])
+    matcher = RuleMatcher(rules)
+    parser = TimestampParser()
+    # The year of the lines is guessed relative to the recording
+    now = os.stat(log_file).st_mtime
+    fires = {}
+    last_fire = {}
+    num_lines = 0
+    first_ts = None
+
+    t0 = time.perf_counter()
+    with open(log_file, 'rb') as fh:
+        for line in fh:
+            line = line.decode('utf-8', 'replace').rstrip('\n')
+            num_lines += 1
+            line_ts = None
+
+            # Replay in N times real time
+            if speed:
+                line_ts = parser.parse(line, now)
+                if line_ts is not None:
+                    if first_ts is None:
+                        first_ts = line_ts
+                    delay = (line_ts - first_ts) / speed - (time.perf_counter() - t0)
+                    if delay > 0:
+                        time.sleep(delay)
+
+            fired = matcher.match(line)
+            if not fired:
+                continue
+            if line_ts is None:
+                line_ts = parser.parse(line, now)
+                if line_ts is None:
+                    continue
+            for m in fired:
+                if not m['window'].add(line_ts):
+                    continue
+                cooldown = m.get('cooldown', config.get('action_cooldown', ACTION_COOLDOWN))
+                cmd = m['command']
+                if cmd in last_fire and line_ts - last_fire[cmd] < cooldown:
+                    status = 'COOLDOWN'
+                else:
+                    status = 'FIRE'
+                    last_fire[cmd] = line_ts
+                    fires[m['match']] = fires.get(m['match'], 0) + 1
+                when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(line_ts))
+                print(f"{when} {status:8} {m['match']} -> {cmd}")
+    elapsed = time.perf_counter() - t0
+
+    print(f"\n{num_lines} lines in {elapsed:.3f} seconds ({num_lines / max(elapsed, 1e-9):.0f} lines/s)")
+    for m in rules:
+        print(f"{fires.get(m['match'], 0):6d}x {m['match']}")
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', type=str, default=CONFIG_FILE, help="Configuration file (default: log_check_config.py)")
+    parser.add_argument('-b', '--benchmark', type=int, nargs='?', const=1000000, help="Measure the matcher on a synthetic notices.log with BENCHMARK lines (default: 1000000)")
+    parser.add_argument('-r', '--replay', type=str, help="Replay a recorded log file without executing commands")
+    parser.add_argument('-s', '--speed', type=float, default=0, help="Replay at SPEED times real time (default: 0, as fast as possible)")
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    try:
+        config, rules = load_config(args.config)
+    except ValueError as e:
+        print(f"[X] {e}")
+        sys.exit(1)
+
+    if args.benchmark:
+        benchmark(rules, args.benchmark)
+        sys.exit(0)
+
+    if args.replay:
+        try:
+            replay(config, rules, args.replay, args.speed)
+        except OSError as e:
+            print(f"[X] {e}")
+            sys.exit(1)
+        sys.exit(0)
+
+    LogCheck(args.config, config, rules).run()
+
+
+if __name__ == '__main__':
+    main()
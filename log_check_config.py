@@ -20,8 +20,16 @@
 
 config = {
     "check_interval": 1,  # (seconds) wait before checking for matches again
+    "action_cooldown": 60,  # (seconds) don't execute a command again within this time after it finished
+    "action_timeout": 600,  # (seconds) kill a command, which hasn't finished within this time
+    "action_log": '/var/log/tor/log_check.log',  # executed commands with exit code and duration
+    "state_file": '/home/torbox/torbox/run/log_check.state',  # positions and windows to resume after a restart
+    "state_interval": 60,  # (seconds) time between two saves of the state
+    "metrics_socket": None,  # unix socket for statistics (Prometheus or JSON), e.g. '/run/log_check.sock'
 }
 
+# Optionally, a rule can have its own "cooldown" (seconds), which overrides action_cooldown
+# Instead of "file", a rule can use "journal": 'tor@default.service' to follow the systemd journal of a unit
 matches = [
     {
         "file": '/var/log/tor/notices.log',